@@ -5,7 +5,7 @@
 import json
 import dateutil.parser
 import babel
-from flask import Flask, render_template, request, Response, flash, redirect, url_for
+from flask import Flask, render_template, request, Response, flash, redirect, url_for, jsonify, abort, Markup
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
 import logging
@@ -13,8 +13,14 @@ from logging import Formatter, FileHandler
 from flask_wtf import Form
 from forms import *
 from flask_migrate import Migrate
+from sqlalchemy import and_, case, func, or_
+from sqlalchemy.orm import joinedload
+from search import NgramIndex, EXACT_NAME, NAME_PREFIX, NAME, CITY, GENRE
+from fragment_cache import FragmentCache
+from itertools import groupby
 import sys
 import datetime
+import time
 
 #----------------------------------------------------------------------------#
 # App Config.
@@ -23,6 +29,11 @@ import datetime
 app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
+# 'trigram' searches with the pg_trgm indexes, 'ngram' with an in-process
+# index, by default trigram on postgresql and ngram elsewhere
+app.config.setdefault('SEARCH_BACKEND', None)
+# memory cap of the rendered page fragments, 0 renders every request
+app.config.setdefault('FRAGMENT_CACHE_BYTES', 16 * 1024 * 1024)
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
@@ -67,10 +78,15 @@ class Artist(db.Model):
 # TODO Implement Show and Artist models, and complete all model relationships and properties, as a database migration.
 class Show(db.Model):
     __tablename__ = 'shows'
+    # past/upcoming splits of a venue or an artist are index range scans
+    __table_args__ = (
+        db.Index('ix_shows_venue_id_start_time', 'venue_id', 'start_time'),
+        db.Index('ix_shows_artist_id_start_time', 'artist_id', 'start_time'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     venue_id = db.Column( db.Integer, db.ForeignKey('Venue.id'), nullable=False)
     artist_id = db.Column( db.Integer, db.ForeignKey('Artist.id'), nullable=False)
-    start_time = db.Column( db.String, nullable=False)
+    start_time = db.Column( db.DateTime(timezone=True), nullable=False)
 
     artists = db.relationship("Artist", backref=db.backref("shows", cascade="all, delete", lazy=True))
     venues = db.relationship("Venue", backref=db.backref("shows", cascade="all, delete", lazy=True))
@@ -79,15 +95,15 @@ class Genre(db.Model):
   __tablename__ = 'genres'
   id= db.Column(db.Integer, primary_key=True)
   name = db.Column( db.String, nullable=False)
-  venue_id = db.Column( db.Integer, db.ForeignKey('Venue.id'), nullable=True)
-  artist_id = db.Column( db.Integer, db.ForeignKey('Artist.id'), nullable=True)
+  venue_id = db.Column( db.Integer, db.ForeignKey('Venue.id'), nullable=True, index=True)
+  artist_id = db.Column( db.Integer, db.ForeignKey('Artist.id'), nullable=True, index=True)
 
 #----------------------------------------------------------------------------#
 # Filters.
 #----------------------------------------------------------------------------#
 
 def format_datetime(value, format='medium'):
-  date = dateutil.parser.parse(value)
+  date = value if isinstance(value, datetime.datetime) else dateutil.parser.parse(value)
   if format == 'full':
       format="EEEE MMMM, d, y 'at' h:mma"
   elif format == 'medium':
@@ -96,6 +112,23 @@ def format_datetime(value, format='medium'):
 
 app.jinja_env.filters['datetime'] = format_datetime
 
+# show start times are timezone aware, stored in UTC
+def now():
+  return datetime.datetime.now(datetime.timezone.utc)
+
+def parse_start_time(value):
+  # naive times entered in the form are local times of the server
+  return dateutil.parser.parse(value).astimezone(datetime.timezone.utc)
+
+# {venue or artist id: number of upcoming shows}, column is Show.venue_id
+# or Show.artist_id, counted in one query
+def upcoming_show_counts(column, ids):
+  if not ids:
+    return {}
+  return dict(db.session.query(column, func.count(Show.id))
+    .filter(column.in_(ids), Show.start_time > now())
+    .group_by(column).all())
+
 #----------------------------------------------------------------------------#
 # Controllers.
 #----------------------------------------------------------------------------#
@@ -105,92 +138,248 @@ def index():
   return render_template('pages/home.html')
 
 
+#  Page fragments
+#  ----------------------------------------------------------------
+
+# the title and content blocks of the list and detail pages, the layout
+# around them (navigation, flashed messages) is rendered on every request
+fragment_cache = FragmentCache(app.config['FRAGMENT_CACHE_BYTES'])
+
+# the upcoming show counts of a list page are at most this many seconds old
+FRAGMENT_MAX_AGE = 60
+
+def render_blocks(template, context):
+  app.update_template_context(context)
+  page = app.jinja_env.get_template(template)
+  return tuple(''.join(page.blocks[block](page.new_context(context)))
+               for block in ('title', 'content'))
+
+# renders template with the context returned by build(), along with the
+# time.time() the page expires at or None, build() only runs on a miss
+#   name, entities: see FragmentCache.key, the write handlers invalidate
+#   the entities
+def render_cached(template, name, entities, build):
+  if not fragment_cache.max_bytes:
+    context, expires = build()
+    return render_template(template, **context)
+  key = fragment_cache.key(name, entities)
+  blocks = fragment_cache.get(key)
+  if blocks is None:
+    context, expires = build()
+    blocks = render_blocks(template, context)
+    fragment_cache.set(key, blocks, expires)
+  return render_template('layouts/cached.html',
+                         title=Markup(blocks[0]), content=Markup(blocks[1]))
+
+# a detail page changes when its first upcoming show starts
+def first_show_expiry(upcoming_shows):
+  if not upcoming_shows:
+    return None
+  start_time = upcoming_shows[0]["start_time"]
+  if start_time.tzinfo is None:
+    start_time = start_time.replace(tzinfo=datetime.timezone.utc)
+  return start_time.timestamp()
+
+
+#  Search
+#  ----------------------------------------------------------------
+
+search_indexes = {'venue': NgramIndex(), 'artist': NgramIndex()}
+
+def search_backend():
+  backend = app.config['SEARCH_BACKEND']
+  if backend is None:
+    backend = 'trigram' if db.engine.dialect.name == 'postgresql' else 'ngram'
+  return backend
+
+def search_columns(kind):
+  if kind == 'venue':
+    return Venue, Genre.venue_id
+  return Artist, Genre.artist_id
+
+def like_pattern(term, prefix=False):
+  term = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+  return term + '%' if prefix else '%' + term + '%'
+
+# [(id, name)] of the venues or artists matching term, ranked like
+# search.match_rank: exact name, name prefix, name, city, then genre
+def ranked_search(kind, term, limit=None):
+  term = term.strip()
+  if not term:
+    return []
+  if search_backend() == 'ngram':
+    index = search_indexes[kind]
+    # a load raced by a write is discarded, the database answers instead
+    if index.loaded or load_search_index(kind):
+      return index.search(term, limit)
+
+  # the ILIKE filters use the gin_trgm_ops indexes, see migrations
+  model, genre_owner = search_columns(kind)
+  pattern = like_pattern(term)
+  genre_match = db.session.query(Genre.id).filter(
+    genre_owner == model.id, Genre.name.ilike(pattern, escape='\\')).exists()
+  rank = case([
+    (func.lower(model.name) == term.lower(), EXACT_NAME),
+    (model.name.ilike(like_pattern(term, prefix=True), escape='\\'), NAME_PREFIX),
+    (model.name.ilike(pattern, escape='\\'), NAME),
+    (model.city.ilike(pattern, escape='\\'), CITY),
+  ], else_=GENRE)
+  return db.session.query(model.id, model.name).filter(or_(
+      model.name.ilike(pattern, escape='\\'),
+      model.city.ilike(pattern, escape='\\'),
+      genre_match)
+    ).order_by(rank, func.lower(model.name), model.id).limit(limit).all()
+
+# rows read before a write committed are discarded, the next search loads
+# them again
+def load_search_index(kind):
+  index = search_indexes[kind]
+  generation = index.generation
+  model, genre_owner = search_columns(kind)
+  genres = {}
+  for owner_id, name in db.session.query(genre_owner, Genre.name).filter(genre_owner.isnot(None)):
+    genres.setdefault(owner_id, []).append(name)
+  rows = db.session.query(model.id, model.name, model.city).all()
+  return index.load(
+    ((row.id, row.name, row.city, genres.get(row.id, ())) for row in rows),
+    generation)
+
+# called by the write handlers, the index is rebuilt on the next search
+def invalidate_search(kind):
+  search_indexes[kind].clear()
+
+# search results with their upcoming shows counted in one query
+def search_results(kind, term, limit=None):
+  matches = ranked_search(kind, term, limit)
+  owner = Show.venue_id if kind == 'venue' else Show.artist_id
+  counts = upcoming_show_counts(owner, [doc_id for doc_id, _ in matches])
+  return [{
+    "id": doc_id,
+    "name": name,
+    "num_upcoming_shows": counts.get(doc_id, 0)
+  } for doc_id, name in matches]
+
+# most results of each kind returned by /search
+SEARCH_MAX_LIMIT = 100
+
+@app.route('/search')
+def search():
+  # ranked search over venue and artist names, cities and genres
+  #   GET /search?term=jazz&limit=10
+  # limit must be a positive integer, larger values are capped
+  term = request.args.get('term', '')
+  limit = request.args.get('limit', '20')
+  if not limit.isdigit() or int(limit) < 1:
+    abort(400)
+  limit = min(int(limit), SEARCH_MAX_LIMIT)
+  return jsonify({
+    "venues": search_results('venue', term, limit),
+    "artists": search_results('artist', term, limit),
+  })
+
+
+#  Detail pages
+#  ----------------------------------------------------------------
+
+# most shows listed per section of a detail page, the counts are exact
+DETAIL_SHOWS_LIMIT = 100
+
+# the shows of a venue or an artist split into past and upcoming, in one
+# query: window functions count each part and number its shows, only the
+# latest past and the next upcoming DETAIL_SHOWS_LIMIT are returned
+#   owner: Show.venue_id or Show.artist_id
+#   other: the model at the other end of the shows, Artist or Venue
+#   keys: the names of other's id, name and image_link in the results
+# returns (past shows, latest first, upcoming shows, past count,
+# upcoming count)
+def show_partitions(owner, owner_id, other, keys):
+  other_id = Show.artist_id if other is Artist else Show.venue_id
+  upcoming = case([(Show.start_time > now(), 1)], else_=0)
+  shows = db.session.query(
+      other.id, other.name, other.image_link, Show.start_time,
+      upcoming.label('upcoming'),
+      func.count(Show.id).over(partition_by=upcoming).label('total'),
+      func.row_number().over(partition_by=upcoming, order_by=(Show.start_time, Show.id)).label('seq')
+    ).join(Show, other_id == other.id).filter(owner == owner_id).subquery()
+  rows = db.session.query(shows).filter(or_(
+      and_(shows.c.upcoming == 1, shows.c.seq <= DETAIL_SHOWS_LIMIT),
+      and_(shows.c.upcoming == 0, shows.c.seq > shows.c.total - DETAIL_SHOWS_LIMIT))
+    ).order_by(shows.c.upcoming, shows.c.seq).all()
+
+  parts = {0: [], 1: []}
+  counts = {0: 0, 1: 0}
+  for row in rows:
+    parts[row.upcoming].append({
+      keys[0]: row[0],
+      keys[1]: row[1],
+      keys[2]: row[2],
+      "start_time": row.start_time
+    })
+    counts[row.upcoming] = row.total
+  parts[0].reverse()
+  return parts[0], parts[1], counts[0], counts[1]
+
+
 #  Venues
 #  ----------------------------------------------------------------
 
 @app.route('/venues')
 def venues():
+  return render_cached('pages/venues.html', 'venues', ['venues'], venues_page)
+
+def venues_page():
   # DONE: replace with real venues data.
   #       num_shows should be aggregated based on number of upcoming shows per venue.
   
-  locations=db.session.query(Venue.city, Venue.state).group_by(Venue.city).group_by(Venue.state).all()
+  # one query: every venue ordered by area, with its upcoming shows
+  # counted by the outer join, venues without upcoming shows count 0
+  rows = db.session.query(
+      Venue.city, Venue.state, Venue.id, Venue.name, func.count(Show.id)
+    ).outerjoin(Show, and_(Show.venue_id == Venue.id,
+                           Show.start_time > now())
+    ).group_by(Venue.id
+    ).order_by(Venue.state, Venue.city, Venue.id).all()
   data=[]
-  for locData in locations:
-    arr={
-      "city": locData[0],
-      "state": locData[1]
-    }
-    vArr=[]
-    venues = db.session.query(Venue).filter_by(city=locData[0], state=locData[1]).all()
-    for v in venues:
-      num_upcoming_shows = len(v.shows)
-      vArr.append({
-        "id": v.id,
-        "name": v.name,
-        "num_upcoming_shows": num_upcoming_shows,
-      })
-    arr["venues"]= vArr
-    data.append(arr)
-
-  return render_template('pages/venues.html', areas=data);
+  for (city, state), venues in groupby(rows, key=lambda row: (row[0], row[1])):
+    data.append({
+      "city": city,
+      "state": state,
+      "venues": [{
+        "id": v[2],
+        "name": v[3],
+        "num_upcoming_shows": v[4],
+      } for v in venues]
+    })
+
+  return {"areas": data}, time.time() + FRAGMENT_MAX_AGE
 
 @app.route('/venues/search', methods=['POST'])
 def search_venues():
   # TODO: implement search on artists with partial string search. Ensure it is case-insensitive.
   # seach for Hop should return "The Musical Hop".
   # search for "Music" should return "The Musical Hop" and "Park Square Live Music & Coffee"
-  search = "%{}%".format(request.form.get("search_term"))
-  venues = Venue.query.filter(Venue.name.ilike(search)).all()
-  count=0
-  data=[]
-  for v in venues:
-    shows=v.shows
-    count=0
-    for sh in shows:
-        date_time_obj = datetime.datetime.strptime(sh.start_time, '%Y-%m-%d %H:%M:%S')
-        if date_time_obj>datetime.datetime.now():
-          count = count+1
-    data.append({
-      "id": v.id,
-      "name": v.name,
-      "num_upcoming_shows": count
-    })
+  data = search_results('venue', request.form.get('search_term', ''))
   response={
-    "count": len(venues),
+    "count": len(data),
     "data": data
   }
   return render_template('pages/search_venues.html', results=response, search_term=request.form.get('search_term', ''))
 
 @app.route('/venues/<int:venue_id>')
 def show_venue(venue_id):
+  return render_cached('pages/show_venue.html', 'venue', [('venue', venue_id)],
+                       lambda: venue_page(venue_id))
+
+def venue_page(venue_id):
   # shows the venue page with the given venue_id
   # TODO: replace with real venue data from the venues table, using venue_id
-  venue = Venue.query.get(venue_id)
-  upcoming_shows=[]
-  past_shows= db.session.query(Artist.id, Artist.name, Artist.image_link, Show.start_time).join(Show).filter_by(venue_id=venue_id).all()
-  pShows=[]
-  uShows=[]
-  for item in past_shows:
-    date_time_obj = datetime.datetime.strptime(item[3], '%Y-%m-%d %H:%M:%S')
-    if date_time_obj<datetime.datetime.now():
-      pShows.append({
-        "artist_id": item[0],
-        "artist_name": item[1],
-        "artist_image_link": item[2],
-        "start_time": item[3]
-      })
-    else:
-      uShows.append({
-        "artist_id": item[0],
-        "artist_name": item[1],
-        "artist_image_link": item[2],
-        "start_time": item[3]
-      })
-
-  genres=db.session.query(Genre.name).filter(Genre.venue_id==venue.id).all()
-  gList=[]
-  for g in genres:
-    gList.append(g.name)
+  # two queries: the venue with its genres, then its shows
+  venue = Venue.query.options(joinedload(Venue.genres)).get(venue_id)
+  if venue is None:
+    abort(404)
+  pShows, uShows, past_count, upcoming_count = show_partitions(
+    Show.venue_id, venue_id, Artist, ("artist_id", "artist_name", "artist_image_link"))
+  gList = [g.name for g in venue.genres]
   data={
     "id": venue.id,
     "name": venue.name,
@@ -206,10 +395,10 @@ def show_venue(venue_id):
     "image_link": venue.image_link,
     "past_shows": pShows,
     "upcoming_shows": uShows,
-    "past_shows_count": len(pShows),
-    "upcoming_shows_count": len(uShows),
+    "past_shows_count": past_count,
+    "upcoming_shows_count": upcoming_count,
   }
-  return render_template('pages/show_venue.html', venue=data)
+  return {"venue": data}, first_show_expiry(uShows)
 
 #  Create Venue
 #  ----------------------------------------------------------------
@@ -244,6 +433,8 @@ def create_venue_submission():
     v.facebook_link = venue.get("facebook_link")
     db.session.add(v)
     db.session.commit()
+    invalidate_search('venue')
+    fragment_cache.invalidate('venues')
   except:
     sys.exc_info()
     db.session.rollback()
@@ -266,8 +457,14 @@ def delete_venue(venue_id):
   # DONE: Complete this endpoint for taking a venue_id, and using
   # SQLAlchemy ORM to delete a record. Handle cases where the session commit could fail.
   try:
+    # the artists who played the venue list it on their pages
+    artist_ids = [a for a, in db.session.query(Show.artist_id).filter(
+      Show.venue_id == venue_id).distinct()]
     Venue.query.filter_by(id=venue_id).delete()
     db.session.commit()
+    invalidate_search('venue')
+    fragment_cache.invalidate('venues', 'shows', ('venue', int(venue_id)),
+                              *[('artist', a) for a in artist_ids])
   except:
     db.session.rollback()
   finally:
@@ -280,68 +477,40 @@ def delete_venue(venue_id):
 #  ----------------------------------------------------------------
 @app.route('/artists')
 def artists():
+  return render_cached('pages/artists.html', 'artists', ['artists'], artists_page)
+
+def artists_page():
   # DONE: replace with real data returned from querying the database
   data=Artist.query.all()
-  return render_template('pages/artists.html', artists=data)
+  return {"artists": data}, None
 
 @app.route('/artists/search', methods=['POST'])
 def search_artists():
   # TODO: implement search on artists with partial string search. Ensure it is case-insensitive.
   # seach for "A" should return "Guns N Petals", "Matt Quevado", and "The Wild Sax Band".
   # search for "band" should return "The Wild Sax Band".
-  search = "%{}%".format(request.form.get("search_term"))
-  artists = Artist.query.filter(Artist.name.ilike(search)).all()
-  count=0
-  data=[]
-  for v in artists:
-    shows=v.shows
-    count=0
-    for sh in shows:
-        date_time_obj = datetime.datetime.strptime(sh.start_time, '%Y-%m-%d %H:%M:%S')
-        if date_time_obj>datetime.datetime.now():
-          count = count+1
-    data.append({
-      "id": v.id,
-      "name": v.name,
-      "num_upcoming_shows": count
-    })
+  data = search_results('artist', request.form.get('search_term', ''))
   response={
-    "count": len(artists),
+    "count": len(data),
     "data": data
   }
   return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''))
 
 @app.route('/artists/<int:artist_id>')
 def show_artist(artist_id):
+  return render_cached('pages/show_artist.html', 'artist', [('artist', artist_id)],
+                       lambda: artist_page(artist_id))
+
+def artist_page(artist_id):
   # shows the venue page with the given venue_id
   # TODO: replace with real venue data from the venues table, using venue_id
-  artist = Artist.query.get(artist_id)
-  
-  past_shows= db.session.query(Venue.id, Venue.name, Venue.image_link, Show.start_time).join(Show).filter_by(artist_id=artist_id).all()
-  
-  pShows=[]
-  uShows=[]
-  for item in past_shows:
-    date_time_obj = datetime.datetime.strptime(item[3], '%Y-%m-%d %H:%M:%S')
-    if date_time_obj<datetime.datetime.now():
-      pShows.append({
-        "venue_id": item[0],
-        "venue_name": item[1],
-        "venue_image_link": item[2],
-        "start_time": item[3]
-      })
-    else:
-      uShows.append({
-        "venue_id": item[0],
-        "venue_name": item[1],
-        "venue_image_link": item[2],
-        "start_time": item[3]
-      })
-  
-  genres=db.session.query(Genre.name).filter(Genre.artist_id==artist.id).all()
-  gList=[]
-  for g in genres:
-    gList.append(g.name)
+  # two queries: the artist with its genres, then its shows
+  artist = Artist.query.options(joinedload(Artist.genres)).get(artist_id)
+  if artist is None:
+    abort(404)
+  pShows, uShows, past_count, upcoming_count = show_partitions(
+    Show.artist_id, artist_id, Venue, ("venue_id", "venue_name", "venue_image_link"))
+  gList = [g.name for g in artist.genres]
   data={
     "id": artist.id,
     "name": artist.name,
@@ -356,11 +525,11 @@ def show_artist(artist_id):
     "image_link": artist.image_link,
     "past_shows": pShows,
     "upcoming_shows": uShows,
-    "past_shows_count": len(pShows),
-    "upcoming_shows_count": len(uShows),
+    "past_shows_count": past_count,
+    "upcoming_shows_count": upcoming_count,
   }
   
-  return render_template('pages/show_artist.html', artist=data)
+  return {"artist": data}, first_show_expiry(uShows)
 
 #  Update
 #  ----------------------------------------------------------------
@@ -449,6 +618,8 @@ def create_artist_submission():
     a.facebook_link = artist.get("facebook_link")
     db.session.add(a)
     db.session.commit()
+    invalidate_search('artist')
+    fragment_cache.invalidate('artists')
   except:
     db.session.rollback()
     error = True
@@ -472,6 +643,9 @@ def create_artist_submission():
 
 @app.route('/shows')
 def shows():
+  return render_cached('pages/shows.html', 'shows', ['shows'], shows_page)
+
+def shows_page():
   # displays list of shows at /shows
   # Done: replace with real venues data.
   #       num_shows should be aggregated based on number of upcoming shows per venue.
@@ -487,7 +661,7 @@ def shows():
     "start_time": x[0]
     })
 
-  return render_template('pages/shows.html', shows=data)
+  return {"shows": data}, None
 
 @app.route('/shows/create')
 def create_shows():
@@ -506,9 +680,12 @@ def create_show_submission():
     print(showF)
     show.artist_id = showF.get("artist_id")
     show.venue_id = showF.get("venue_id")
-    show.start_time = showF.get("start_time")
+    show.start_time = parse_start_time(showF.get("start_time"))
     db.session.add(show)
     db.session.commit()
+    # the artists page lists no shows, it stays cached
+    fragment_cache.invalidate('venues', 'shows', ('venue', int(showF.get("venue_id"))),
+                              ('artist', int(showF.get("artist_id"))))
   except:
     db.session.rollback()
     error = True
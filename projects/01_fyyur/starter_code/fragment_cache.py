@@ -0,0 +1,106 @@
+#----------------------------------------------------------------------------#
+# Cache of rendered page fragments.
+#----------------------------------------------------------------------------#
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class FragmentCache:
+  '''
+  rendered template fragments, tuples of strings, cached under a key made
+  of a name and the versions of the entities they show, i.e. ('venue', 3)
+  or 'venues'
+  invalidate(entity) bumps the version of the entity and drops every
+  fragment showing it, fragments of other entities stay cached
+  the least recently used fragments are evicted once their text takes
+  more than max_bytes, max_bytes=0 disables the cache
+  a fragment can expire at a given time.time(), i.e. when a show moves
+  from upcoming to past
+  EXAMPLE
+    key = cache.key('venue', [('venue', 3)])
+    fragment = cache.get(key)
+    if fragment is None:
+      fragment = (render(),)
+      cache.set(key, fragment)
+  '''
+
+  def __init__(self, max_bytes=16 * 1024 * 1024):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._fragments = OrderedDict()
+    self._versions = {}
+    self._dependents = {}
+    self._lock = threading.Lock()
+
+  def key(self, name, entities):
+    with self._lock:
+      return (name,) + tuple((entity, self._versions.get(entity, 0)) for entity in entities)
+
+  def get(self, key):
+    with self._lock:
+      entry = self._fragments.get(key)
+      if entry is not None and (entry[2] is None or entry[2] > time.time()):
+        self._fragments.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+      if entry is not None:
+        self._remove(key)
+      self.misses += 1
+      return None
+
+  def set(self, key, fragment, expires=None):
+    size = sum(len(part.encode('utf-8')) for part in fragment)
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      # an entity changed while the fragment was rendered, it is stale
+      if any(self._versions.get(entity, 0) != version for entity, version in key[1:]):
+        return
+      if key in self._fragments:
+        self._remove(key)
+      self._fragments[key] = (fragment, size, expires)
+      self.size += size
+      for entity, _ in key[1:]:
+        self._dependents.setdefault(entity, set()).add(key)
+      while self.size > self.max_bytes:
+        self._remove(next(iter(self._fragments)))
+        self.evictions += 1
+
+  def invalidate(self, *entities):
+    with self._lock:
+      for entity in entities:
+        self._versions[entity] = self._versions.get(entity, 0) + 1
+        for key in list(self._dependents.get(entity, ())):
+          self._remove(key)
+
+  def clear(self):
+    with self._lock:
+      self._fragments.clear()
+      self._dependents.clear()
+      self.size = 0
+
+  def stats(self):
+    with self._lock:
+      return {
+        "fragments": len(self._fragments),
+        "bytes": self.size,
+        "max_bytes": self.max_bytes,
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions
+      }
+
+  def _remove(self, key):
+    fragment, size, expires = self._fragments.pop(key)
+    self.size -= size
+    for entity, _ in key[1:]:
+      keys = self._dependents.get(entity)
+      if keys is not None:
+        keys.discard(key)
+        if not keys:
+          del self._dependents[entity]
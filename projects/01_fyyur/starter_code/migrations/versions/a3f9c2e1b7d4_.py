@@ -0,0 +1,63 @@
+"""store shows.start_time as an indexed timestamp
+
+Revision ID: a3f9c2e1b7d4
+Revises: 5efb28d4cdd4
+Create Date: 2026-10-18 10:12:41.318027
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f9c2e1b7d4'
+down_revision = '5efb28d4cdd4'
+branch_labels = None
+depends_on = None
+
+# rows converted per UPDATE, keeps each statement short on big tables
+BATCH_SIZE = 10000
+
+
+def backfill(statement):
+    # walk the shows by id range, one bounded UPDATE per batch
+    # env.py runs the migration in one transaction, which would hold the
+    # lock taken by add_column until the end: the transaction is committed
+    # first and every batch commits on its own, so shows stays writable
+    # in between
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        last_id = bind.execute(sa.text('SELECT max(id) FROM shows')).scalar() or 0
+        for start in range(0, last_id, BATCH_SIZE):
+            bind.execute(sa.text(statement),
+                         {'start': start, 'end': start + BATCH_SIZE})
+
+
+def upgrade():
+    op.add_column('shows', sa.Column('start_time_tz', sa.DateTime(timezone=True), nullable=True))
+    # the strings hold local times of the server, ::timestamptz reads them
+    # in the session time zone
+    backfill("UPDATE shows SET start_time_tz = start_time::timestamptz "
+             "WHERE id > :start AND id <= :end")
+    # shows written during the backfill, converted under the lock of the
+    # last transaction
+    op.execute("UPDATE shows SET start_time_tz = start_time::timestamptz "
+               "WHERE start_time_tz IS NULL")
+    op.drop_column('shows', 'start_time')
+    op.alter_column('shows', 'start_time_tz', new_column_name='start_time', nullable=False)
+    op.create_index('ix_shows_venue_id_start_time', 'shows', ['venue_id', 'start_time'])
+    op.create_index('ix_shows_artist_id_start_time', 'shows', ['artist_id', 'start_time'])
+
+
+def downgrade():
+    op.drop_index('ix_shows_artist_id_start_time', table_name='shows')
+    op.drop_index('ix_shows_venue_id_start_time', table_name='shows')
+    op.add_column('shows', sa.Column('start_time_text', sa.String(), nullable=True))
+    backfill("UPDATE shows SET start_time_text = "
+             "to_char(start_time, 'YYYY-MM-DD HH24:MI:SS') "
+             "WHERE id > :start AND id <= :end")
+    op.execute("UPDATE shows SET start_time_text = "
+               "to_char(start_time, 'YYYY-MM-DD HH24:MI:SS') "
+               "WHERE start_time_text IS NULL")
+    op.drop_column('shows', 'start_time')
+    op.alter_column('shows', 'start_time_text', new_column_name='start_time', nullable=False)
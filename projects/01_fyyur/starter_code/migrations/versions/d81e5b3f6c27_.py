@@ -0,0 +1,42 @@
+"""trigram indexes for the venue and artist search
+
+Revision ID: d81e5b3f6c27
+Revises: a3f9c2e1b7d4
+Create Date: 2026-10-18 14:03:27.552190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd81e5b3f6c27'
+down_revision = 'a3f9c2e1b7d4'
+branch_labels = None
+depends_on = None
+
+# (index, table, column) searched with ILIKE '%term%' by ranked_search()
+INDEXES = [
+    ('ix_venue_name_trgm', 'Venue', 'name'),
+    ('ix_venue_city_trgm', 'Venue', 'city'),
+    ('ix_artist_name_trgm', 'Artist', 'name'),
+    ('ix_artist_city_trgm', 'Artist', 'city'),
+    ('ix_genres_name_trgm', 'genres', 'name'),
+]
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, table, column in INDEXES:
+        op.create_index(name, table, [column], postgresql_using='gin',
+                        postgresql_ops={column: 'gin_trgm_ops'})
+    # the genre subqueries look genres up by their venue or artist
+    op.create_index('ix_genres_venue_id', 'genres', ['venue_id'])
+    op.create_index('ix_genres_artist_id', 'genres', ['artist_id'])
+
+
+def downgrade():
+    op.drop_index('ix_genres_artist_id', table_name='genres')
+    op.drop_index('ix_genres_venue_id', table_name='genres')
+    for name, table, column in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,96 @@
+#----------------------------------------------------------------------------#
+# In-process search index, used when the database has no trigram index.
+#----------------------------------------------------------------------------#
+
+import threading
+from collections import defaultdict
+
+# ranks of a match, lower ranks first
+EXACT_NAME, NAME_PREFIX, NAME, CITY, GENRE = range(5)
+
+
+def trigrams(text):
+  return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def match_rank(term, name, city, genres):
+  # best rank of a match of the lowercased term, None if nothing matches
+  if name == term:
+    return EXACT_NAME
+  if name.startswith(term):
+    return NAME_PREFIX
+  if term in name:
+    return NAME
+  if term in city:
+    return CITY
+  if any(term in genre for genre in genres):
+    return GENRE
+  return None
+
+
+class NgramIndex:
+  '''
+  case-insensitive substring search over names, cities and genres
+  every document is indexed by the trigrams of its fields, a search only
+  checks the documents having all trigrams of the term, terms shorter
+  than 3 characters check every document
+  load(documents) replaces the content with (id, name, city, genres)
+  tuples, clear() empties it until the next load
+  clear() bumps generation, a load of documents read before a clear()
+  is discarded, pass the generation read before reading them
+  '''
+
+  def __init__(self):
+    self.loaded = False
+    self.generation = 0
+    self._documents = {}
+    self._postings = {}
+    self._lock = threading.Lock()
+
+  def load(self, documents, generation=None):
+    # True if the documents were loaded
+    indexed = {}
+    postings = defaultdict(set)
+    for doc_id, name, city, genres in documents:
+      fields = ((name or '').lower(), (city or '').lower(),
+                tuple(genre.lower() for genre in genres))
+      indexed[doc_id] = (name or '',) + fields
+      for text in fields[:2] + fields[2]:
+        for gram in trigrams(text):
+          postings[gram].add(doc_id)
+    with self._lock:
+      if generation is not None and generation != self.generation:
+        return False
+      self._documents = indexed
+      self._postings = dict(postings)
+      self.loaded = True
+    return True
+
+  def clear(self):
+    with self._lock:
+      self.generation += 1
+      self._documents = {}
+      self._postings = {}
+      self.loaded = False
+
+  def search(self, term, limit=None):
+    # [(id, name)] ranked by match_rank, then name
+    term = term.strip().lower()
+    if not term:
+      return []
+    with self._lock:
+      documents, postings = self._documents, self._postings
+    grams = trigrams(term)
+    if grams:
+      sets = sorted((postings.get(gram, set()) for gram in grams), key=len)
+      candidates = set.intersection(*sets)
+    else:
+      candidates = documents.keys()
+    ranked = []
+    for doc_id in candidates:
+      name, lower_name, city, genres = documents[doc_id]
+      rank = match_rank(term, lower_name, city, genres)
+      if rank is not None:
+        ranked.append((rank, lower_name, doc_id, name))
+    ranked.sort()
+    return [(doc_id, name) for _, _, doc_id, name in ranked[:limit]]
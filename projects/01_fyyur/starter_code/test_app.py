@@ -0,0 +1,300 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask import template_rendered
+from sqlalchemy import event
+
+from app import app, db, fragment_cache, invalidate_search, search_indexes, \
+    Venue, Artist, Show, Genre
+from fragment_cache import FragmentCache
+
+
+class FyyurTestCase(unittest.TestCase):
+    """This class represents the fyyur test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.tmp_dir = tempfile.mkdtemp()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(
+            os.path.join(self.tmp_dir, 'fyyur.db'))
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SEARCH_BACKEND'] = None
+        for index in search_indexes.values():
+            index.clear()
+        fragment_cache.clear()
+        fragment_cache.max_bytes = 0
+        self.client = app.test_client
+        with app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.get_engine(app).dispose()
+        shutil.rmtree(self.tmp_dir)
+
+    def count_queries(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            engine = db.get_engine(app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute',
+                        before_cursor_execute)
+        return statements
+
+    def rendered_context(self):
+        contexts = []
+
+        def record(sender, template, context, **extra):
+            contexts.append(context)
+
+        template_rendered.connect(record, app)
+        self.addCleanup(template_rendered.disconnect, record, app)
+        return contexts
+
+    def seed_venues(self, count, shows_per_venue=2):
+        times = [in_days(-30), in_days(30)]
+        with app.app_context():
+            db.session.execute(Venue.__table__.insert(), [{
+                'id': i + 1,
+                'name': 'venue {}'.format(i),
+                'city': 'city {}'.format(i % 50),
+                'state': 'CA'
+            } for i in range(count)])
+            db.session.execute(Artist.__table__.insert(),
+                               [{'id': 1, 'name': 'artist'}])
+            shows = [{
+                'venue_id': i % count + 1,
+                'artist_id': 1,
+                'start_time': times[i % 2]
+            } for i in range(count * shows_per_venue)]
+            if shows:
+                db.session.execute(Show.__table__.insert(), shows)
+            db.session.commit()
+
+    def test_venues_counts_upcoming_shows(self):
+        self.seed_venues(3)
+        contexts = self.rendered_context()
+        res = self.client().get('/venues')
+        self.assertEqual(res.status_code, 200)
+        venues = [v for area in contexts[0]['areas'] for v in area['venues']]
+        self.assertEqual([v['num_upcoming_shows'] for v in venues],
+                         [1, 1, 1])
+
+    def test_show_venue_splits_past_and_upcoming_shows(self):
+        self.seed_venues(1, shows_per_venue=3)
+        contexts = self.rendered_context()
+        res = self.client().get('/venues/1')
+        self.assertEqual(res.status_code, 200)
+        venue = contexts[0]['venue']
+        self.assertEqual(venue['past_shows_count'], 2)
+        self.assertEqual(venue['upcoming_shows_count'], 1)
+
+    def test_detail_pages_use_a_constant_number_of_queries(self):
+        for shows in (5, 2000):
+            with self.subTest(shows=shows):
+                with app.app_context():
+                    db.drop_all()
+                    db.create_all()
+                self.seed_venues(1, shows_per_venue=shows)
+                statements = self.count_queries()
+                contexts = self.rendered_context()
+                for path in ('/venues/1', '/artists/1'):
+                    res = self.client().get(path)
+                    self.assertEqual(res.status_code, 200)
+                self.assertEqual(len(statements), 4)
+                venue, artist = contexts[0]['venue'], contexts[1]['artist']
+                past = (shows + 1) // 2
+                for page in (venue, artist):
+                    self.assertEqual(page['past_shows_count'], past)
+                    self.assertEqual(page['upcoming_shows_count'],
+                                     shows - past)
+                    self.assertEqual(len(page['past_shows']),
+                                     min(past, 100))
+                self.assertEqual(venue['upcoming_shows'][0]['artist_id'], 1)
+
+    def test_detail_page_of_missing_venue(self):
+        res = self.client().get('/venues/1')
+        self.assertEqual(res.status_code, 404)
+
+    def test_create_show_stores_a_timestamp(self):
+        self.seed_venues(1, shows_per_venue=0)
+        res = self.client().post('/shows/create', data={
+            'artist_id': 1, 'venue_id': 1,
+            'start_time': '2035-04-01 21:30:00+02:00'})
+        self.assertEqual(res.status_code, 200)
+        with app.app_context():
+            start_time = Show.query.one().start_time
+        self.assertEqual(start_time.replace(tzinfo=None),
+                         datetime.datetime(2035, 4, 1, 19, 30))
+
+    def seed_search(self):
+        with app.app_context():
+            venues = [
+                Venue(name='The Musical Hop', city='San Francisco',
+                      genres=[Genre(name='Jazz')]),
+                Venue(name='Park Square Live Music & Coffee',
+                      city='San Francisco', genres=[Genre(name='Folk')]),
+                Venue(name='Hop Shop', city='New York'),
+                Venue(name='Jazz Corner', city='Boston',
+                      genres=[Genre(name='Hip Hop')]),
+            ]
+            artist = Artist(name='Guns N Petals', city='San Francisco')
+            db.session.add_all(venues + [artist])
+            db.session.flush()
+            db.session.add(Show(venue_id=venues[2].id, artist_id=artist.id,
+                                start_time=in_days(10)))
+            db.session.commit()
+
+    def search(self, term):
+        res = self.client().get('/search', query_string={'term': term})
+        self.assertEqual(res.status_code, 200)
+        return res.get_json()
+
+    def test_search_is_ranked(self):
+        self.seed_search()
+        for backend in ('trigram', 'ngram'):
+            with self.subTest(backend=backend):
+                app.config['SEARCH_BACKEND'] = backend
+                venues = self.search('hop')['venues']
+                self.assertEqual([v['name'] for v in venues], [
+                    'Hop Shop', 'The Musical Hop', 'Jazz Corner'])
+                self.assertEqual(venues[0]['num_upcoming_shows'], 1)
+                self.assertEqual([v['name'] for v in
+                                  self.search('MUSIC')['venues']], [
+                    'Park Square Live Music & Coffee', 'The Musical Hop'])
+                data = self.search('san f')
+                self.assertEqual(len(data['venues']), 2)
+                self.assertEqual([a['name'] for a in data['artists']],
+                                 ['Guns N Petals'])
+                self.assertEqual(self.search('a_b%')['venues'], [])
+
+    def test_search_limit_is_validated(self):
+        self.seed_search()
+        for limit in ('0', '-1', 'ten'):
+            with self.subTest(limit=limit):
+                res = self.client().get('/search', query_string={
+                    'term': 'hop', 'limit': limit})
+                self.assertEqual(res.status_code, 400)
+        res = self.client().get('/search', query_string={
+            'term': 'hop', 'limit': '1000000'})
+        self.assertEqual(len(res.get_json()['venues']), 3)
+        res = self.client().get('/search', query_string={
+            'term': 'hop', 'limit': '1'})
+        self.assertEqual([v['name'] for v in res.get_json()['venues']],
+                         ['Hop Shop'])
+
+    def test_search_index_is_invalidated_by_writes(self):
+        app.config['SEARCH_BACKEND'] = 'ngram'
+        self.seed_search()
+        self.assertEqual(self.search('blue')['venues'], [])
+        self.client().post('/venues/create', data={
+            'name': 'Blue Note', 'city': 'New York', 'state': 'NY',
+            'genres': 'Jazz'})
+        self.assertEqual([v['name'] for v in self.search('blue')['venues']],
+                         ['Blue Note'])
+
+    def test_search_index_load_raced_by_a_write_is_discarded(self):
+        app.config['SEARCH_BACKEND'] = 'ngram'
+        self.seed_search()
+        writes = []
+
+        def write_during_load(conn, cursor, statement, *args):
+            # a venue is committed right after the index read the venues
+            if not writes and 'FROM "Venue"' in statement and \
+                    'genres' not in statement:
+                writes.append(statement)
+                invalidate_search('venue')
+
+        with app.app_context():
+            engine = db.get_engine(app)
+        event.listen(engine, 'after_cursor_execute', write_during_load)
+        self.addCleanup(event.remove, engine, 'after_cursor_execute',
+                        write_during_load)
+        self.assertEqual([v['name'] for v in self.search('hop')['venues']],
+                         ['Hop Shop', 'The Musical Hop', 'Jazz Corner'])
+        self.assertFalse(search_indexes['venue'].loaded)
+        self.assertEqual(len(self.search('hop')['venues']), 3)
+        self.assertTrue(search_indexes['venue'].loaded)
+
+    def test_venues_query_count_is_constant(self):
+        statements = self.count_queries()
+        for count in (10, 1000, 100000):
+            with self.subTest(venues=count):
+                with app.app_context():
+                    db.drop_all()
+                    db.create_all()
+                self.seed_venues(count, shows_per_venue=1)
+                del statements[:]
+                res = self.client().get('/venues')
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(len(statements), 1)
+
+    def test_cached_pages_run_no_queries(self):
+        fragment_cache.max_bytes = 1024 * 1024
+        self.seed_venues(2)
+        paths = ('/venues', '/artists', '/shows', '/venues/1', '/artists/1')
+        pages = [self.client().get(path).data for path in paths]
+        statements = self.count_queries()
+        for path, page in zip(paths, pages):
+            res = self.client().get(path)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.data, page)
+        self.assertEqual(statements, [])
+        self.assertIn(b'venue 1', pages[0])
+
+    def test_writes_invalidate_affected_fragments(self):
+        fragment_cache.max_bytes = 1024 * 1024
+        self.seed_venues(2)
+        paths = ('/venues', '/artists', '/shows', '/venues/1', '/venues/2',
+                 '/artists/1')
+        for path in paths:
+            self.client().get(path)
+        self.client().post('/shows/create', data={
+            'artist_id': 1, 'venue_id': 2,
+            'start_time': '2035-04-01 21:30:00'})
+        statements = self.count_queries()
+        for path in ('/artists', '/venues/1'):
+            self.client().get(path)
+        self.assertEqual(statements, [])
+        contexts = self.rendered_context()
+        for path in ('/venues', '/shows', '/venues/2', '/artists/1'):
+            self.client().get(path)
+        self.assertEqual(len(contexts), 4)
+        self.assertIn(b'2035', self.client().get('/shows').data)
+
+    def test_fragment_cache_evicts_least_recently_used(self):
+        cache = FragmentCache(max_bytes=10)
+        for name in ('a', 'b'):
+            cache.set(cache.key(name, [name]), ('1234',))
+        self.assertEqual(cache.get(cache.key('a', ['a'])), ('1234',))
+        cache.set(cache.key('c', ['c']), ('12', '34'))
+        self.assertIsNone(cache.get(cache.key('b', ['b'])))
+        self.assertEqual(cache.stats()['bytes'], 8)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        # rendered before the invalidation, never stored
+        key = cache.key('a', ['a'])
+        cache.invalidate('a')
+        cache.set(key, ('stale',))
+        self.assertIsNone(cache.get(cache.key('a', ['a'])))
+        cache.set(cache.key('big', ['big']), ('x' * 11,))
+        self.assertEqual(cache.stats()['fragments'], 1)
+
+
+def in_days(days):
+    return datetime.datetime.now(datetime.timezone.utc) + \
+        datetime.timedelta(days=days)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
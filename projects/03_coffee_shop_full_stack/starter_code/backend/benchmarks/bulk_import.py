@@ -0,0 +1,61 @@
+'''
+compares POST /drinks/bulk with one POST /drinks per drink on sqlite
+
+    python -m benchmarks.bulk_import [count]
+'''
+import sys
+import time
+
+from src.api import app
+from src.database.models import db
+from .support import benchmark_app
+
+
+def drinks(count, prefix):
+    return [{
+        'title': '{} {}'.format(prefix, i),
+        'recipe': [
+            {'name': 'espresso', 'color': 'brown', 'parts': 1},
+            {'name': 'milk', 'color': 'white', 'parts': 3}
+        ]
+    } for i in range(count)]
+
+
+def single_posts(client, headers, count):
+    for drink in drinks(count, 'single'):
+        res = client.post('/drinks', headers=headers, json=drink)
+        assert res.status_code == 200, res.data
+
+
+def bulk_post(client, headers, count):
+    res = client.post('/drinks/bulk', headers=headers,
+                      json=drinks(count, 'bulk'))
+    assert res.status_code == 200, res.data
+    assert res.get_json()['inserted'] == count
+
+
+def run(count):
+    results = {}
+    for name, scenario in (('single', single_posts), ('bulk', bulk_post)):
+        with benchmark_app() as identity_provider:
+            client = app.test_client()
+            headers = identity_provider.headers(['post:drinks'])
+            start = time.perf_counter()
+            scenario(client, headers, count)
+            results[name] = time.perf_counter() - start
+            with app.app_context():
+                db.session.remove()
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    results = run(count)
+    for name, elapsed in results.items():
+        print('{:<8}{:>6} drinks {:>9.3f}s {:>10.1f} drinks/s'.format(
+            name, count, elapsed, count / elapsed))
+    print('speedup {:.1f}x'.format(results['single'] / results['bulk']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''
+compares serializing the whole menu from ORM Drink instances and from
+DrinkRow plain rows
+
+    python -m benchmarks.read_model [drinks] [rounds]
+'''
+import json
+import sys
+import time
+import tracemalloc
+
+from sqlalchemy.orm import selectinload
+
+from src.api import app
+from src.database.models import db, Drink, DrinkRow
+from .support import benchmark_app
+
+RECIPE = [
+    {'name': 'espresso', 'color': 'brown', 'parts': 1},
+    {'name': 'milk', 'color': 'white', 'parts': 3}
+]
+
+
+def orm_menu():
+    drinks = Drink.query.options(selectinload(Drink.ingredients)).all()
+    return json.dumps([drink.long() for drink in drinks])
+
+
+def row_menu():
+    return json.dumps([drink.long() for drink in DrinkRow.load()])
+
+
+def measure(build, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        build()
+        db.session.remove()
+    elapsed = (time.perf_counter() - start) / rounds
+    tracemalloc.start()
+    build()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db.session.remove()
+    return elapsed, peak
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with benchmark_app():
+        with app.app_context():
+            Drink.insert_many([('drink {}'.format(i), RECIPE)
+                               for i in range(count)])
+            for name, build in (('orm', orm_menu), ('rows', row_menu)):
+                elapsed, peak = measure(build, rounds)
+                print('{:<5}{:>7} drinks {:>8.1f}ms  peak {:>7.1f}MiB'.format(
+                    name, count, elapsed * 1000, peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
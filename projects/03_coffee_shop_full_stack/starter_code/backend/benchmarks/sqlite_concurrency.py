@@ -0,0 +1,75 @@
+'''
+measures read throughput of the drinks api while writes are in flight,
+with the default sqlite settings and with SQLITE_PROFILE
+
+    python -m benchmarks.sqlite_concurrency [seconds] [readers] [writers]
+'''
+import sys
+import threading
+import time
+
+from src.api import app
+from src.database.models import Drink, SQLITE_PROFILE
+from .support import benchmark_app
+
+PROFILES = (('default', {}), ('profile', SQLITE_PROFILE))
+RECIPE = [
+    {'name': 'espresso', 'color': 'brown', 'parts': 1},
+    {'name': 'milk', 'color': 'white', 'parts': 3}
+]
+
+
+def reader(client, stop, counts):
+    while not stop.is_set():
+        # paginated reads bypass the menu cache and always hit sqlite
+        res = client.get('/drinks?limit=100')
+        counts['reads' if res.status_code == 200 else 'errors'] += 1
+
+
+def writer(client, headers, stop, counts, number):
+    i = 0
+    while not stop.is_set():
+        res = client.post('/drinks', headers=headers, json={
+            'title': 'writer {} drink {}'.format(number, i),
+            'recipe': RECIPE})
+        counts['writes' if res.status_code == 200 else 'errors'] += 1
+        i += 1
+
+
+def run(sqlite_profile, seconds, readers, writers):
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    with benchmark_app(sqlite_profile) as identity_provider:
+        with app.app_context():
+            Drink.insert_many([('seed {}'.format(i), RECIPE)
+                               for i in range(1000)])
+        headers = identity_provider.headers(['post:drinks'])
+        stop = threading.Event()
+        threads = [threading.Thread(
+            target=reader, args=(app.test_client(), stop, counts))
+            for _ in range(readers)]
+        threads += [threading.Thread(
+            target=writer,
+            args=(app.test_client(), headers, stop, counts, number))
+            for number in range(writers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return {name: count / seconds for name, count in counts.items()}
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    writers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    for name, sqlite_profile in PROFILES:
+        rates = run(sqlite_profile, seconds, readers, writers)
+        print('{:<8} reads/s {:>8.1f}  writes/s {:>7.1f}  errors/s {:>6.1f}'
+              .format(name, rates['reads'], rates['writes'],
+                      rates['errors']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+'''
+offline benchmark suite for the coffee shop api
+
+seeds throwaway sqlite databases of each size, signs tokens with a local
+identity provider and runs every scenario against the api, reporting
+throughput and latency percentiles
+
+    python -m benchmarks.suite
+    python -m benchmarks.suite --sizes 100,10000 --requests 500
+    python -m benchmarks.suite --save baseline.json
+    python -m benchmarks.suite --compare baseline.json --tolerance 0.25
+
+with --compare the exit status is 1 when a scenario's p95 latency grew,
+or its throughput dropped, by more than the tolerance
+'''
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+from src.api import app
+from src.database.models import Drink
+from .support import benchmark_app
+
+SIZES = (100, 10000, 100000)
+PERMISSIONS = ['get:drinks-detail', 'post:drinks', 'patch:drinks',
+               'delete:drinks']
+RECIPE = [
+    {'name': 'espresso', 'color': 'brown', 'parts': 1},
+    {'name': 'milk', 'color': 'white', 'parts': 3}
+]
+
+
+def seed(count, chunk_size=5000):
+    with app.app_context():
+        for start in range(0, count, chunk_size):
+            Drink.insert_many([('drink {}'.format(i), RECIPE) for i in
+                               range(start, min(count, start + chunk_size))])
+
+
+'''
+scenarios
+    each scenario returns a function issuing one request with the given
+    test client, and returning its status code
+'''
+
+
+def public_reads(size, headers):
+    def request(client, rng):
+        if rng.random() < 0.9:
+            return client.get('/drinks').status_code
+        after = rng.randrange(size)
+        return client.get('/drinks?limit=50&after={}'.format(after)) \
+            .status_code
+    return request
+
+
+def authenticated_reads(size, headers):
+    def request(client, rng):
+        return client.get('/drinks-detail', headers=headers).status_code
+    return request
+
+
+def mixed_writes(size, headers):
+    counter = iter(range(10 ** 9))
+
+    def request(client, rng):
+        roll = rng.random()
+        if roll < 0.7:
+            return client.get('/drinks').status_code
+        if roll < 0.85:
+            return client.post('/drinks', headers=headers, json={
+                'title': 'new drink {}'.format(next(counter)),
+                'recipe': RECIPE}).status_code
+        drink_id = rng.randrange(1, size + 1)
+        if roll < 0.95:
+            return client.patch('/drinks/{}'.format(drink_id),
+                                headers=headers, json={
+                                    'title': 'patched {}'.format(
+                                        next(counter)),
+                                    'recipe': RECIPE}).status_code
+        return client.delete('/drinks/{}'.format(drink_id),
+                             headers=headers).status_code
+    return request
+
+
+SCENARIOS = {
+    'public_reads': public_reads,
+    'authenticated_reads': authenticated_reads,
+    'mixed_writes': mixed_writes
+}
+
+
+def percentile(latencies, q):
+    if not latencies:
+        return 0.0
+    index = min(len(latencies) - 1, max(0, int(q * len(latencies) + 0.5) - 1))
+    return latencies[index]
+
+
+def run_scenario(scenario, size, requests, threads, headers):
+    request = scenario(size, headers)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(number, count):
+        client = app.test_client()
+        rng = random.Random(number)
+        local_latencies = []
+        local_errors = 0
+        for _ in range(count):
+            start = time.perf_counter()
+            status = request(client, rng)
+            local_latencies.append(time.perf_counter() - start)
+            # deleting or patching an already deleted drink is expected
+            if status >= 500:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    workers = [threading.Thread(target=worker, args=(
+        number, requests // threads + (number < requests % threads)))
+        for number in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000
+    }
+
+
+def run(sizes, scenarios, requests, threads):
+    results = {}
+    for size in sizes:
+        for name in scenarios:
+            # every scenario starts from a freshly seeded database
+            with benchmark_app() as identity_provider:
+                seed(size)
+                headers = identity_provider.headers(PERMISSIONS)
+                result = run_scenario(SCENARIOS[name], size, requests,
+                                      threads, headers)
+            results['{}/{}'.format(name, size)] = result
+            print_result('{}/{}'.format(name, size), result)
+    return results
+
+
+def print_result(key, result):
+    print('{:<28} {:>9.1f} req/s  p50 {:>8.2f}ms  p95 {:>8.2f}ms  '
+          'p99 {:>8.2f}ms  errors {}'.format(
+              key, result['rps'], result['p50_ms'], result['p95_ms'],
+              result['p99_ms'], result['errors']))
+
+
+'''
+regressions(baseline, results, tolerance)
+    returns a message for every scenario that got slower than the
+    baseline by more than tolerance (0.25 is 25%)
+'''
+
+
+def regressions(baseline, results, tolerance):
+    messages = []
+    for key, result in results.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            messages.append('{}: p95 {:.2f}ms, baseline {:.2f}ms'.format(
+                key, result['p95_ms'], before['p95_ms']))
+        if result['rps'] < before['rps'] * (1 - tolerance):
+            messages.append('{}: {:.1f} req/s, baseline {:.1f}'.format(
+                key, result['rps'], before['rps']))
+    return messages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated catalog sizes')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated scenario names')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests per scenario and size')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline results file')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    scenarios = args.scenarios.split(',')
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(unknown)))
+
+    results = run(sizes, scenarios, args.requests, args.threads)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            messages = regressions(json.load(f), results, args.tolerance)
+        for message in messages:
+            print('REGRESSION ' + message)
+        return 1 if messages else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
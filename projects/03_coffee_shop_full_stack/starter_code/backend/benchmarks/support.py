@@ -0,0 +1,91 @@
+import base64
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from Crypto.PublicKey import RSA
+from jose import jwt
+
+from src.api import app
+from src.auth import auth
+from src.auth.jwks import JWKSCache
+from src.database.models import db, use_sqlite_profile, SQLITE_PROFILE
+
+
+'''
+LocalIdentityProvider
+    a stand-in for Auth0: an rsa key pair whose public half is served
+    to the api through a local jwks.json file
+    tokens minted by it pass requires_auth with the given permissions
+'''
+
+
+class LocalIdentityProvider:
+    def __init__(self, directory, kid='benchmark-key'):
+        self.kid = kid
+        self.rsa_key = RSA.generate(2048)
+        self.private_pem = self.rsa_key.exportKey('PEM').decode()
+        self.jwks_path = os.path.join(directory, 'jwks.json')
+        with open(self.jwks_path, 'w') as f:
+            json.dump({'keys': [{
+                'kty': 'RSA',
+                'kid': kid,
+                'use': 'sig',
+                'n': b64url_uint(self.rsa_key.n),
+                'e': b64url_uint(self.rsa_key.e)
+            }]}, f)
+
+    def install(self):
+        auth.jwks_cache = JWKSCache('file://' + self.jwks_path)
+
+    def token(self, permissions, expires_in=3600):
+        claims = {
+            'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+            'aud': auth.API_AUDIENCE,
+            'sub': 'benchmark|user',
+            'exp': int(time.time()) + expires_in,
+            'permissions': permissions
+        }
+        return jwt.encode(claims, self.private_pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def headers(self, permissions):
+        return {'Authorization': 'Bearer ' + self.token(permissions)}
+
+
+def b64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+'''
+benchmark_app(sqlite_profile)
+    points the api at a fresh sqlite database in a temporary directory,
+    using the given sqlite profile, and at a LocalIdentityProvider
+    yields the identity provider
+'''
+
+
+@contextmanager
+def benchmark_app(sqlite_profile=SQLITE_PROFILE):
+    directory = tempfile.mkdtemp()
+    jwks_cache = auth.jwks_cache
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(
+        os.path.join(directory, 'benchmark.db'))
+    use_sqlite_profile(app, sqlite_profile)
+    try:
+        identity_provider = LocalIdentityProvider(directory)
+        identity_provider.install()
+        with app.app_context():
+            db.create_all()
+        yield identity_provider
+    finally:
+        auth.jwks_cache = jwks_cache
+        with app.app_context():
+            db.session.remove()
+            db.get_engine(app).dispose()
+        use_sqlite_profile(app, SQLITE_PROFILE)
+        shutil.rmtree(directory)
@@ -0,0 +1,102 @@
+'''
+compares validating drink payloads with DRINK_SCHEMA before any database
+work against the previous path, which assigned the payload to a Drink and
+relied on the insert failing, with mostly invalid input
+
+    python -m benchmarks.validation [count] [invalid ratio]
+'''
+import random
+import sys
+import time
+
+from sqlalchemy import event
+
+from src.api import app, validate_drink
+from src.database.models import db, Drink
+from .support import benchmark_app
+
+RECIPE = [{'name': 'espresso', 'color': 'brown', 'parts': 1}]
+INVALID = [
+    {'recipe': RECIPE},
+    {'title': 'no recipe'},
+    {'title': 'empty recipe', 'recipe': []},
+    {'title': 'bad parts', 'recipe': [{'color': 'red', 'parts': 'x'}]},
+    {'title': 'missing color', 'recipe': [{'name': 'milk', 'parts': 1}]},
+    {'title': 7, 'recipe': RECIPE},
+    ['not', 'a', 'drink']
+]
+
+
+def payloads(count, invalid_ratio, seed=0):
+    rng = random.Random(seed)
+    return [rng.choice(INVALID) if rng.random() < invalid_ratio else
+            {'title': 'drink {}'.format(i), 'recipe': RECIPE}
+            for i in range(count)]
+
+
+def previous_path(data):
+    try:
+        drink = Drink()
+        drink.title = data["title"]
+        drink.recipe = data["recipe"]
+        drink.insert()
+        return 200
+    except BaseException:
+        db.session.rollback()
+        return 400
+
+
+def compiled_path(data):
+    if validate_drink(data) is not None:
+        return 400
+    try:
+        drink = Drink()
+        drink.title = data["title"]
+        drink.recipe = data["recipe"]
+        drink.insert()
+        return 200
+    except BaseException:
+        db.session.rollback()
+        return 400
+
+
+def run(count, invalid_ratio):
+    results = {}
+    for name, handle in (('previous', previous_path),
+                         ('compiled', compiled_path)):
+        with benchmark_app():
+            statements = []
+            engine = db.get_engine(app)
+
+            def before_cursor_execute(*args):
+                statements.append(1)
+
+            event.listen(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            with app.app_context():
+                start = time.perf_counter()
+                statuses = [handle(data) for data in
+                            payloads(count, invalid_ratio)]
+                elapsed = time.perf_counter() - start
+                db.session.remove()
+            event.remove(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        results[name] = (elapsed, len(statements), statuses.count(400))
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    invalid_ratio = float(sys.argv[2]) if len(sys.argv) > 2 else 0.8
+    results = run(count, invalid_ratio)
+    for name, (elapsed, statements, rejected) in results.items():
+        print('{:<10}{:>7} payloads {:>9.3f}s {:>10.1f} payloads/s '
+              '{:>7} statements {:>6} rejected'.format(
+                  name, count, elapsed, count / elapsed, statements,
+                  rejected))
+    print('speedup {:.1f}x'.format(
+        results['previous'][0] / results['compiled'][0]))
+
+
+if __name__ == '__main__':
+    main()
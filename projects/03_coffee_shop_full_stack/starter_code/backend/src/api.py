@@ -1,15 +1,170 @@
 import os
-from flask import Flask, request, jsonify, abort
+from flask import Flask, request, jsonify, abort, stream_with_context
 from sqlalchemy import exc
+from sqlalchemy.orm import selectinload
+from werkzeug.exceptions import HTTPException
 import json
 from flask_cors import CORS
-
-from .database.models import db_drop_and_create_all, setup_db, Drink
+import click
+
+from .database.models import db_drop_and_create_all, setup_db, db, Drink, \
+    DrinkRow, Ingredient, ChangeCounter, DrinkTombstone, menu_caches, \
+    tenant_engines, upgrade_db, use_tenant_databases, create_tenant
+from .database.backup import BackupScheduler, database_file
+from .database.tenants import TenantLocal, set_tenant, valid_tenant
+from .auth import auth
 from .auth.auth import AuthError, requires_auth
+from . import metrics
+from .events import EventBroadcaster
+from .metrics import timed
+from .schema import ValidationError, compile_schema
 
 app = Flask(__name__)
 setup_db(app)
 CORS(app)
+# stream the drinks lists straight from the database instead of caching
+# them, keeps memory bounded for very large menus
+app.config.setdefault("STREAM_DRINKS", False)
+# keep each shop in its own sqlite file in this directory, the shop is
+# selected by the X-Tenant-ID header or the tenant claim of the token
+if os.environ.get("TENANT_DATABASES"):
+    use_tenant_databases(app, os.environ["TENANT_DATABASES"])
+# back the database up into this directory every BACKUP_INTERVAL seconds
+backup_scheduler = None
+if os.environ.get("BACKUP_DIRECTORY"):
+    backup_scheduler = BackupScheduler(
+        database_file(app.config["SQLALCHEMY_DATABASE_URI"]),
+        os.environ["BACKUP_DIRECTORY"],
+        interval=float(os.environ.get("BACKUP_INTERVAL", 3600)))
+    backup_scheduler.start()
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 100
+DRINK_FIELDS = ("id", "title", "recipe")
+TENANT_HEADER = "X-Tenant-ID"
+TENANT_CLAIM = "tenant"
+
+
+'''
+service_metrics()
+    token cache, identity provider, event stream, tenant and backup
+    metrics for /metrics
+'''
+
+
+def service_metrics():
+    token_stats = auth.token_cache.stats()
+    flight_stats = [cache.flights.stats() for cache in menu_caches.all()]
+    tenant_stats = tenant_engines.stats()
+    extra = {
+        "coffee_shop_token_cache_hits_total": (
+            "counter", "Bearer tokens served from the verified token cache.",
+            token_stats["hits"]),
+        "coffee_shop_token_cache_misses_total": (
+            "counter", "Bearer tokens that needed a signature check.",
+            token_stats["misses"]),
+        "coffee_shop_jwks_circuit_open": (
+            "gauge", "1 while the JWKS circuit breaker is not closed.",
+            int(auth.jwks_cache.breaker.state != "closed")),
+        "coffee_shop_menu_builds_total": (
+            "counter", "Menu bodies built after a cache miss.",
+            sum(stats["calls"] for stats in flight_stats)),
+        "coffee_shop_menu_builds_coalesced_total": (
+            "counter", "Menu cache misses that waited for a running build.",
+            sum(stats["coalesced"] for stats in flight_stats)),
+        "coffee_shop_menu_stream_subscribers": (
+            "gauge", "Open GET /drinks/stream connections.",
+            sum(events.subscribers for events in menu_event_feeds.all())),
+        "coffee_shop_tenant_engines_open": (
+            "gauge", "Tenant databases with an open engine.",
+            tenant_stats["open"]),
+        "coffee_shop_tenant_engines_evicted_total": (
+            "counter", "Tenant engines disposed to stay within the pool size.",
+            tenant_stats["evicted"])
+    }
+    if backup_scheduler is not None:
+        report = backup_scheduler.last_report
+        extra.update({
+            "coffee_shop_backup_failures_total": (
+                "counter", "Scheduled backups that failed.",
+                backup_scheduler.failures),
+            "coffee_shop_backup_duration_seconds": (
+                "gauge", "Duration of the last backup.",
+                report.seconds if report else 0.0),
+            "coffee_shop_backup_lock_seconds": (
+                "gauge", "Time the last backup held the database lock.",
+                report.lock_seconds if report else 0.0),
+            "coffee_shop_backup_restarts": (
+                "gauge", "Times the last backup started over after a write.",
+                report.restarts if report else 0)
+        })
+    return extra
+
+
+# record Server-Timing and per route latencies when SERVER_TIMING is set
+metrics.init_app(app, extra_metrics=service_metrics)
+
+# menu changes pushed to GET /drinks/stream subscribers, per tenant
+# dropped with the tenant's engine, unless a stream is still open
+menu_event_feeds = TenantLocal(
+    EventBroadcaster, in_use=lambda events: events.subscribers > 0)
+menu_events = menu_event_feeds.default
+tenant_engines.on_evict.append(menu_event_feeds.discard)
+
+
+'''
+select_tenant()
+    routes the request to a tenant database when tenant databases are
+    enabled, requests without a tenant use the app database
+    the tenant comes from the tenant claim of a valid bearer token or the
+    X-Tenant-ID header, a header naming another tenant than the token
+    is rejected with 403
+    tenants without a database get a 404, they are created with
+    `flask create-tenant <tenant>`
+'''
+
+
+@app.before_request
+def select_tenant():
+    if not tenant_engines.enabled:
+        return
+    tenant = request.headers.get(TENANT_HEADER)
+    claimed = token_tenant()
+    if claimed is not None:
+        if tenant is not None and tenant != claimed:
+            abort(403)
+        tenant = claimed
+    if tenant is None:
+        return
+    if not valid_tenant(tenant):
+        abort(400)
+    if not tenant_engines.exists(tenant):
+        abort(404)
+    set_tenant(tenant)
+
+
+def token_tenant():
+    if "Authorization" not in request.headers:
+        return None
+    try:
+        payload = auth.verified_payload()
+    except (AuthError, HTTPException):
+        # left to requires_auth, public endpoints ignore the token
+        return None
+    return payload.get(TENANT_CLAIM)
+
+
+@app.cli.command("create-tenant")
+@click.argument("tenant")
+def create_tenant_command(tenant):
+    '''creates the database of a new tenant'''
+    if not tenant_engines.enabled:
+        raise click.ClickException("TENANT_DATABASES is not set")
+    if not valid_tenant(tenant):
+        raise click.BadParameter("invalid tenant id: {!r}".format(tenant))
+    click.echo("created " + create_tenant(tenant))
+
 
 '''
 @TODO uncomment the following line to initialize the datbase
@@ -18,6 +173,155 @@ CORS(app)
 '''
 # db_drop_and_create_all()
 
+'''
+@TODO uncomment the following line once to upgrade a database created by
+an older version of the models (recipe blobs, change versions)
+'''
+# upgrade_db()
+
+
+'''
+list_drinks(form)
+    serves the cached menu, or a single page of it when the request has
+    any of the limit, after or fields query parameters
+    the menu is streamed instead of cached when STREAM_DRINKS is set
+'''
+
+
+def list_drinks(form):
+    if not {"limit", "after", "fields"}.isdisjoint(request.args):
+        return drinks_page_response(form)
+    if app.config["STREAM_DRINKS"]:
+        return stream_menu_response(form)
+    return menu_response(form)
+
+
+'''
+menu_response(form)
+    serves the whole menu in the given drink representation
+    ('short' or 'long') from the menu cache of the tenant
+    the body is only rebuilt, with a single query, after the menu changed
+    responses carry a strong etag, a matching If-None-Match gets a 304
+    without touching the database
+'''
+
+
+def menu_response(form):
+    entry = menu_caches.current().get(form, lambda: build_menu_body(form))
+    if entry.body is None:
+        abort(404)
+    if request.if_none_match.contains(entry.etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(
+            entry.body, status=200, mimetype="application/json")
+    response.set_etag(entry.etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def build_menu_body(form):
+    drinks = DrinkRow.load()
+    if len(drinks) == 0:
+        return None
+    with timed("serialize"):
+        return json.dumps({
+            "success": True,
+            "drinks": [getattr(drink, form)() for drink in drinks]
+        }).encode("utf-8")
+
+
+'''
+stream_menu_response(form)
+    streams the whole menu as json while it is read from the database
+    cursor, in chunks of STREAM_CHUNK_SIZE drinks
+    the body is the same {"success": true, "drinks": [...]} document
+'''
+
+
+def stream_menu_response(form):
+    drinks = DrinkRow.stream()
+    first = next(drinks, None)
+    if first is None:
+        abort(404)
+
+    def generate():
+        chunk = ['{"success": true, "drinks": [',
+                 json.dumps(getattr(first, form)())]
+        for drink in drinks:
+            chunk.append(",")
+            chunk.append(json.dumps(getattr(drink, form)()))
+            if len(chunk) >= 2 * STREAM_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+        chunk.append("]}")
+        yield "".join(chunk)
+
+    return app.response_class(stream_with_context(generate()), status=200,
+                              mimetype="application/json")
+
+
+'''
+drinks_page_response(form)
+    keyset pagination over the drinks, ordered by id
+    ?limit=<n> page size, defaults to DEFAULT_PAGE_SIZE
+    ?after=<id> only drinks with a larger id, the "next" value of the
+        previous page
+    ?fields=title,recipe only select and return these fields, the id is
+        always returned
+returns status code 200 and json {"success": True, "drinks": drinks,
+"next": id} where next is null on the last page
+    or status code 400 for invalid parameters
+'''
+
+
+def drinks_page_response(form):
+    limit = int_arg("limit", DEFAULT_PAGE_SIZE)
+    after = int_arg("after", 0)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400)
+    fields = request.args.get("fields", ",".join(DRINK_FIELDS)).split(",")
+    if not set(fields) <= set(DRINK_FIELDS):
+        abort(400)
+
+    columns = [Drink.id]
+    if "title" in fields:
+        columns.append(Drink.title)
+    rows = db.session.query(*columns).filter(Drink.id > after) \
+        .order_by(Drink.id).limit(limit + 1).all()
+    next_after = rows[limit - 1].id if len(rows) > limit else None
+    rows = rows[:limit]
+
+    recipes = {}
+    if "recipe" in fields and rows:
+        recipes = Ingredient.recipes(rows[0].id, rows[-1].id, form)
+
+    drinks = []
+    for row in rows:
+        drink = {"id": row.id}
+        if "title" in fields:
+            drink["title"] = row.title
+        if "recipe" in fields:
+            drink["recipe"] = recipes.get(row.id, [])
+        drinks.append(drink)
+    with timed("serialize"):
+        return jsonify({
+            "success": True,
+            "drinks": drinks,
+            "next": next_after
+        }), 200
+
+
+def int_arg(name, default):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
 # ROUTES
 '''
 @TODO implement endpoint
@@ -31,13 +335,7 @@ CORS(app)
 
 @app.route("/drinks")
 def get_drinks():
-    drinks = Drink.query.all()
-    if len(drinks) != 0:
-        return jsonify({
-            "success": True,
-            "drinks": [drink.short() for drink in drinks]
-        }), 200
-    abort(404)
+    return list_drinks("short")
 
 
 '''
@@ -53,13 +351,79 @@ def get_drinks():
 @app.route("/drinks-detail")
 @requires_auth('get:drinks-detail')
 def get_drinks_details(payload):
-    drinks = Drink.query.all()
-    if len(drinks) != 0:
-        return jsonify({
-            "success": True,
-            "drinks": [drink.long() for drink in drinks]
-        }), 200
-    abort(404)
+    return list_drinks("long")
+
+
+'''
+GET /drinks/changes
+    delta sync for the menu, it is a public endpoint
+    ?since=<version> the "version" of the previous sync, 0 for everything
+    ?limit=<n> maximum number of changes, defaults to MAX_PAGE_SIZE
+    both queries are range scans on the indexed change versions
+returns status code 200 and json {"success": True, "version": version,
+"more": more, "drinks": drinks, "deleted": ids} where drinks holds the
+drink.short() of drinks inserted or updated since the given version, ids
+the ids of drinks deleted since then, version the version to sync from
+next time and more is true when the limit cut the changes short
+    or status code 400 for invalid parameters
+'''
+
+
+@app.route("/drinks/changes")
+def get_drink_changes():
+    since = int_arg("since", 0)
+    limit = int_arg("limit", MAX_PAGE_SIZE)
+    if since < 0 or not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400)
+
+    current = ChangeCounter.current()
+    changed = [(drink.version, drink) for drink in Drink.query
+               .options(selectinload(Drink.ingredients))
+               .filter(Drink.version > since)
+               .order_by(Drink.version).limit(limit + 1)]
+    deleted = [(tombstone.version, tombstone.drink_id) for tombstone in
+               DrinkTombstone.query.filter(DrinkTombstone.version > since)
+               .order_by(DrinkTombstone.version).limit(limit + 1)]
+    changes = sorted(changed + deleted, key=lambda change: change[0])
+    more = len(changes) > limit
+    changes = changes[:limit]
+    version = changes[-1][0] if more else current
+
+    return jsonify({
+        "success": True,
+        "version": version,
+        "more": more,
+        "drinks": [change.short() for _, change in changes
+                   if isinstance(change, Drink)],
+        "deleted": [change for _, change in changes
+                    if not isinstance(change, Drink)]
+    }), 200
+
+
+'''
+GET /drinks/stream
+    server-sent events feed of menu changes, it is a public endpoint
+    sends a 'created' or 'updated' event with {"drink": drink.short()}
+    or a 'deleted' event with {"id": id} after each committed change,
+    and a heartbeat comment while idle
+    event ids are change versions, a client reconnecting with the
+    Last-Event-ID header gets the events it missed, or a 'reset' event
+    with {"since": id} asking it to catch up through /drinks/changes
+'''
+
+
+@app.route("/drinks/stream")
+def stream_drink_events():
+    try:
+        last_event_id = int(request.headers["Last-Event-ID"])
+    except (KeyError, ValueError):
+        last_event_id = None
+    events = menu_event_feeds.current().subscribe(
+        last_event_id, ChangeCounter.current())
+    response = app.response_class(events, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
 
 '''
@@ -76,15 +440,14 @@ def get_drinks_details(payload):
 @app.route("/drinks", methods=["POST"])
 @requires_auth('post:drinks')
 def add_drinks(payload):
+    data = drink_payload()
     try:
-        data = request.get_json(force=True)
-        # dumps_recipe = json.dumps(data["recipe"])
-        # drink = Drink(title=data["title"], recipe=dumps_recipe)
-        data = request.get_json(force=True)
         drink = Drink()
         drink.title = data["title"]
-        drink.recipe = json.dumps(data["recipe"])
+        drink.recipe = data["recipe"]
         drink.insert()
+        menu_event_feeds.current().publish(
+            [(drink.version, "created", {"drink": drink.short()})])
         return jsonify({
             "success": True,
             "drinks": [drink.long()]
@@ -93,6 +456,131 @@ def add_drinks(payload):
         abort(400)
 
 
+'''
+POST /drinks/bulk
+    creates many drinks in a single transaction
+    it should require the 'post:drinks' permission
+    the body is a json array of drinks, or one drink per line when sent
+    as application/x-ndjson
+    all drinks are validated first, the valid ones are inserted together
+returns status code 200 and json {"success": True, "inserted": count,
+"drinks": results} where results holds, for each submitted drink in order,
+{"index": i, "success": True, "id": id} or
+{"index": i, "success": False, "message": reason}
+    or status code 400 if the body is not a list of drinks
+'''
+
+
+@app.route("/drinks/bulk", methods=["POST"])
+@requires_auth('post:drinks')
+def add_drinks_bulk(payload):
+    items = read_bulk_drinks()
+    results = [None] * len(items)
+    titles = {}
+    for index, item in enumerate(items):
+        message = validate_drink(item)
+        if message is None and item["title"] in titles:
+            message = "duplicate title"
+        if message is not None:
+            results[index] = {
+                "index": index, "success": False, "message": message}
+        else:
+            titles[item["title"]] = index
+
+    for title in Drink.existing_titles(titles):
+        index = titles.pop(title)
+        results[index] = {
+            "index": index, "success": False, "message": "duplicate title"}
+
+    try:
+        ids = Drink.insert_many(
+            [(title, items[index]["recipe"]) for title, index in
+             titles.items()])
+    except BaseException:
+        abort(422)
+    for index, drink_id in zip(titles.values(), ids):
+        results[index] = {"index": index, "success": True, "id": drink_id}
+    if ids:
+        drinks = Drink.query.options(selectinload(Drink.ingredients)) \
+            .filter(Drink.id.between(min(ids), max(ids))) \
+            .order_by(Drink.version)
+        menu_event_feeds.current().publish(
+            [(drink.version, "created", {"drink": drink.short()})
+             for drink in drinks])
+
+    return jsonify({
+        "success": True,
+        "inserted": len(ids),
+        "drinks": results
+    }), 200
+
+
+def read_bulk_drinks():
+    if request.mimetype == "application/x-ndjson":
+        items = []
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+        return items
+    items = request.get_json(force=True, silent=True)
+    if not isinstance(items, list):
+        abort(400)
+    return items
+
+
+'''
+DRINK_SCHEMA
+    the drink payload of POST /drinks, POST /drinks/bulk and
+    PATCH /drinks/<id>, a recipe is a list of ingredients or a single one
+validate_drink(data)
+    returns the reason a drink payload is invalid, None if it is valid
+    compiled once from DRINK_SCHEMA, see schema.py
+'''
+
+INGREDIENT_SCHEMA = {
+    "type": "object",
+    "required": ["color", "parts"],
+    "properties": {
+        "color": {"type": "string"},
+        "name": {"type": "string"},
+        "parts": {"type": "integer"}
+    }
+}
+
+DRINK_SCHEMA = {
+    "type": "object",
+    "required": ["title", "recipe"],
+    "properties": {
+        "title": {"type": "string", "minLength": 1, "maxLength": 80,
+                  "blank": False},
+        "recipe": {"type": "array", "minItems": 1, "single": True,
+                   "items": INGREDIENT_SCHEMA}
+    }
+}
+
+validate_drink = compile_schema(DRINK_SCHEMA, "drink")
+
+
+'''
+drink_payload()
+    the json body of the request, validated against DRINK_SCHEMA
+    before any database work
+    raises ValidationError, answered with a 400 naming the invalid field
+'''
+
+
+def drink_payload():
+    data = request.get_json(force=True, silent=True)
+    message = validate_drink(data)
+    if message is not None:
+        raise ValidationError(message)
+    return data
+
+
 '''
 @TODO implement endpoint
     PATCH /drinks/<id>
@@ -109,12 +597,16 @@ def add_drinks(payload):
 @app.route("/drinks/<int:drink_id>", methods=["PATCH"])
 @requires_auth('patch:drinks')
 def edit_drinks(payload, drink_id):
+    data = drink_payload()
+    drink = Drink.query.filter_by(id=drink_id).first()
+    if drink is None:
+        abort(404)
     try:
-        drink = Drink.query.filter_by(id=drink_id).first()
-        data = request.get_json(force=True)
         drink.title = data["title"]
-        drink.recipe = json.dumps(data["recipe"])
+        drink.recipe = data["recipe"]
         drink.update()
+        menu_event_feeds.current().publish(
+            [(drink.version, "updated", {"drink": drink.short()})])
         return jsonify({
             "success": True,
             "drinks": [drink.long()]
@@ -140,7 +632,9 @@ def edit_drinks(payload, drink_id):
 def delete_drinks(payload, drink_id):
     try:
         drink = Drink.query.filter_by(id=drink_id).first()
-        drink.delete()
+        version = drink.delete()
+        menu_event_feeds.current().publish(
+            [(version, "deleted", {"id": drink_id})])
         return jsonify({
             "success": True,
             "delete": drink_id
@@ -206,6 +700,15 @@ def bad_request(error):
 '''
 
 
+@app.errorhandler(ValidationError)
+def invalid_payload(error):
+    return jsonify({
+        "success": False,
+        "error": 400,
+        "message": error.message
+    }), 400
+
+
 @app.errorhandler(AuthError)
 def auth_error(error):
     return jsonify({
@@ -1,13 +1,28 @@
-import json
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+
+from ..metrics import timed
+from .jwks import JWKSCache
+from .permissions import all_of, any_of, compile_permission
+from .token_cache import VerifiedTokenCache
 
 
 AUTH0_DOMAIN = 'dev-9xbw2-ug.us.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'drinks'
+JWKS_URL = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+# seconds the signing keys are trusted before being fetched again
+JWKS_CACHE_TTL = 600
+# seconds to wait for the identity provider before giving up
+JWKS_FETCH_TIMEOUT = 3
+
+# maximum number of verified tokens remembered by requires_auth
+TOKEN_CACHE_SIZE = 1024
+
+jwks_cache = JWKSCache(JWKS_URL, ttl=JWKS_CACHE_TTL,
+                       timeout=JWKS_FETCH_TIMEOUT)
+token_cache = VerifiedTokenCache(maxsize=TOKEN_CACHE_SIZE)
 
 # AuthError Exception
 '''
@@ -69,7 +84,8 @@ def get_token_auth_header():
 '''
 @TODO implement check_permissions(permission, payload) method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink') or a permission
+            expression built with any_of() / all_of()
         payload: decoded jwt payload
 
     it should raise an AuthError if permissions are not included in the payload
@@ -80,13 +96,34 @@ def get_token_auth_header():
 
 
 def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        abort(400)
-    if permission not in payload['permissions']:
+    check = permission if callable(permission) else \
+        compile_permission(permission)
+    if not check(granted_permissions(payload)):
         abort(403)
     return True
 
 
+'''
+granted_permissions(payload)
+    returns the permissions of the payload as a frozenset
+    the set is built once per request and kept on the request context,
+    so every check of the request reuses it
+    flask.g is not used: it belongs to the app context, which can outlive
+    the request and would hand the permissions to the next caller
+'''
+
+
+def granted_permissions(payload):
+    ctx = _request_ctx_stack.top
+    if getattr(ctx, 'auth_permissions_of', None) is payload:
+        return ctx.auth_permissions
+    if 'permissions' not in payload:
+        abort(400)
+    ctx.auth_permissions_of = payload
+    ctx.auth_permissions = frozenset(payload['permissions'])
+    return ctx.auth_permissions
+
+
 '''
 @TODO implement verify_decode_jwt(token) method
     @INPUTS
@@ -94,6 +131,8 @@ def check_permissions(permission, payload):
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        the keys are served from jwks_cache, the network is only
+        hit when the cache expires or an unknown kid shows up
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -104,34 +143,25 @@ def check_permissions(permission, payload):
 
 def verify_decode_jwt(token):
 
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    with timed('jwks'):
+        rsa_key = jwks_cache.get_key(unverified_header['kid'])
     if rsa_key:
         try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
+            with timed('jwt'):
+                payload = jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=ALGORITHMS,
+                    audience=API_AUDIENCE,
+                    issuer='https://' + AUTH0_DOMAIN + '/'
+                )
 
             return payload
 
@@ -160,27 +190,49 @@ def verify_decode_jwt(token):
 '''
 @TODO implement @requires_auth(permission) decorator method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink') or a permission
+            expression such as any_of('patch:drinks', 'post:drinks'),
+            compiled once when the view is decorated
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
+        tokens already verified are served from token_cache until
+        they expire, skipping the signature check
+        the header is read on every request, the payload is kept on the
+        request context along with its token, so further checks in the
+        same request neither decode the token nor rebuild its permissions
     it should use the check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
 '''
 
 
 def requires_auth(permission=''):
+    check = compile_permission(permission)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            print(permission)
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except BaseException:
-                abort(401)
-            check_permissions(permission, payload)
+            with timed('auth'):
+                payload = verified_payload()
+                check_permissions(check, payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
+
+
+def verified_payload():
+    token = get_token_auth_header()
+    ctx = _request_ctx_stack.top
+    if getattr(ctx, 'auth_token', None) == token:
+        return ctx.auth_payload
+    payload = token_cache.get(token)
+    if payload is None:
+        try:
+            payload = verify_decode_jwt(token)
+        except BaseException:
+            abort(401)
+        token_cache.set(token, payload)
+    ctx.auth_token = token
+    ctx.auth_payload = payload
+    return payload
@@ -0,0 +1,190 @@
+import json
+import threading
+import time
+from urllib.request import urlopen
+
+
+'''
+CircuitBreaker
+    stops calling a failing dependency for `reset_timeout` seconds
+    once `failure_threshold` consecutive calls have failed
+    after the timeout a single probe call is let through (half open),
+    its outcome closes the circuit again or re-opens it
+'''
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    '''
+    allow()
+        returns True if a call may be attempted now
+        in half open state only the first caller is allowed through
+    '''
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+'''
+JWKSCache
+    a process-wide cache of the identity provider signing keys
+    keys are indexed by their key id (kid) and kept for `ttl` seconds
+    an unknown kid triggers a single refresh (at most once per
+    `min_refresh_interval` seconds) to pick up rotated keys
+    the url can be any address urlopen understands, including
+    file:// urls pointing at a local jwks.json
+
+    fetches give up after `timeout` seconds and go through a circuit
+    breaker, so a slow identity provider cannot stall the workers
+    once keys have been loaded, expired keys keep being served while
+    a refresh runs in the background (stale-while-revalidate), and
+    they stay in use until a refresh succeeds
+'''
+
+
+class JWKSCache:
+    def __init__(self, url, ttl=600, min_refresh_interval=30, timeout=3,
+                 breaker=None, background=True):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.background = background
+        self._keys = {}
+        self._fetched_at = None
+        self._attempted_at = None
+        self._lock = threading.Lock()
+        self._refreshing = threading.Event()
+
+    '''
+    get_key(kid)
+        returns the rsa key for kid, ready to hand to jwt.decode
+        returns None if the identity provider does not know the kid
+        or no keyset could be loaded
+    '''
+
+    def get_key(self, kid):
+        if self._fetched_at is None:
+            self._refresh_if(lambda: self._fetched_at is None)
+        elif self._is_stale():
+            self._revalidate()
+        key = self._keys.get(kid)
+        if key is None and self._can_force_refresh():
+            self._refresh_if(lambda: kid not in self._keys)
+            key = self._keys.get(kid)
+        return key
+
+    '''
+    refresh()
+        fetches the keyset and replaces the cached keys
+        returns True on success, on failure the current keys are kept
+    '''
+
+    def refresh(self):
+        self._attempted_at = time.monotonic()
+        if not self.breaker.allow():
+            return False
+        try:
+            jwks = self.fetch()
+            keys = self.index(jwks)
+        except Exception:
+            self.breaker.record_failure()
+            return False
+        self.breaker.record_success()
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+        return True
+
+    def fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    '''
+    index(jwks)
+        maps each usable rsa key of the keyset to its kid
+    '''
+
+    @staticmethod
+    def index(jwks):
+        keys = {}
+        for key in jwks.get('keys', []):
+            if key.get('kty') != 'RSA' or 'kid' not in key:
+                continue
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use', 'sig'),
+                'n': key['n'],
+                'e': key['e']
+            }
+        return keys
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._attempted_at = None
+
+    def _refresh_if(self, needed):
+        # only one worker fetches, the others wait and reuse its result
+        with self._lock:
+            if needed():
+                self.refresh()
+
+    def _revalidate(self):
+        if self._refreshing.is_set() or not self._can_force_refresh():
+            return
+        self._refreshing.set()
+        if self.background:
+            threading.Thread(target=self._revalidate_worker,
+                             daemon=True).start()
+        else:
+            self._revalidate_worker()
+
+    def _revalidate_worker(self):
+        try:
+            self._refresh_if(self._is_stale)
+        finally:
+            self._refreshing.clear()
+
+    def _is_stale(self):
+        return (self._fetched_at is None or
+                time.monotonic() - self._fetched_at >= self.ttl)
+
+    def _can_force_refresh(self):
+        return (self._attempted_at is None or
+                time.monotonic() - self._attempted_at >=
+                self.min_refresh_interval)
@@ -0,0 +1,60 @@
+'''
+permission expressions for requires_auth
+    a permission is either a single permission string (i.e. 'post:drinks')
+    or an expression built with any_of() and all_of(), which can be nested
+    EXAMPLE
+        @requires_auth(any_of('patch:drinks', 'post:drinks'))
+        @requires_auth(all_of('get:drinks-detail',
+                              any_of('patch:drinks', 'delete:drinks')))
+'''
+
+
+class AnyOf:
+    def __init__(self, *permissions):
+        self.permissions = permissions
+
+    def __repr__(self):
+        return 'any_of({})'.format(', '.join(map(repr, self.permissions)))
+
+
+class AllOf:
+    def __init__(self, *permissions):
+        self.permissions = permissions
+
+    def __repr__(self):
+        return 'all_of({})'.format(', '.join(map(repr, self.permissions)))
+
+
+def any_of(*permissions):
+    return AnyOf(*permissions)
+
+
+def all_of(*permissions):
+    return AllOf(*permissions)
+
+
+'''
+compile_permission(permission)
+    turns a permission expression into a check taking the frozenset of
+    granted permissions and returning True if the expression holds
+    flat expressions compile to a single set operation
+'''
+
+
+def compile_permission(permission):
+    if isinstance(permission, str):
+        return lambda granted: permission in granted
+    if not isinstance(permission, (AnyOf, AllOf)):
+        raise TypeError('not a permission expression: {!r}'.format(
+            permission))
+
+    if all(isinstance(p, str) for p in permission.permissions):
+        required = frozenset(permission.permissions)
+        if isinstance(permission, AllOf):
+            return lambda granted: required <= granted
+        return lambda granted: not required.isdisjoint(granted)
+
+    checks = [compile_permission(p) for p in permission.permissions]
+    if isinstance(permission, AllOf):
+        return lambda granted: all(check(granted) for check in checks)
+    return lambda granted: any(check(granted) for check in checks)
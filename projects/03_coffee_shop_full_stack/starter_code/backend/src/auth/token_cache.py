@@ -0,0 +1,80 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+'''
+VerifiedTokenCache
+    a bounded LRU of already verified jwt payloads
+    entries are keyed by the sha256 digest of the token, so raw tokens
+    are never kept in memory, and expire at the token's exp claim
+    hits and misses are counted for monitoring
+'''
+
+
+class VerifiedTokenCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    '''
+    get(token)
+        returns the cached payload for token
+        returns None if the token was never verified or has expired
+    '''
+
+    def get(self, token):
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, payload = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    '''
+    set(token, payload)
+        stores a verified payload until its exp claim
+        payloads without exp are never cached
+    '''
+
+    def set(self, token, payload):
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)):
+            return
+        if self.maxsize <= 0 or expires_at <= time.time():
+            return
+        key = self.digest(token)
+        with self._lock:
+            self._entries[key] = (expires_at, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'maxsize': self.maxsize
+            }
@@ -0,0 +1,249 @@
+'''
+online backups of the sqlite database
+
+    python -m src.database.backup backup snapshots/menu.db
+    python -m src.database.backup restore snapshots/menu.db
+
+backups use sqlite's online backup api, copying `pages` pages per step
+and pausing between steps, so the database stays readable and writable
+while it is copied
+a step only holds a read lock on the database, in WAL mode writers are
+not blocked at all, a write made by another connection during a backup
+makes the next step start over
+a database written more often than a full pass takes would restart
+forever, after `max_restarts` restarts or `max_seconds` the rest of the
+copy is made in a single step
+'''
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy.engine.url import make_url
+
+BackupReport = namedtuple('BackupReport', [
+    'path', 'pages', 'steps', 'seconds', 'lock_seconds', 'max_lock_seconds',
+    'restarts', 'single_step'])
+
+
+class _GiveUpSteps(Exception):
+    '''raised from the progress callback to stop a restarting backup'''
+
+
+'''
+backup(source, destination, pages, pause, progress, max_restarts,
+       max_seconds)
+    copies the sqlite file source to destination, `pages` pages per step
+    with a `pause` seconds sleep between steps
+    progress(copied, total) is called after every step
+    once the copy started over more than `max_restarts` times, or ran for
+    more than `max_seconds` (None: no limit), it is finished in a single
+    step, which holds the read lock for the whole copy but cannot be
+    restarted
+    the copy is written next to destination and renamed once complete,
+    so destination is always a whole snapshot
+    returns a BackupReport, lock_seconds is the time spent inside steps
+    holding the database lock, max_lock_seconds the longest single step,
+    restarts the number of times the copy started over and single_step
+    whether it was finished in a single step
+'''
+
+
+def backup(source, destination, pages=256, pause=0.005, progress=None,
+           max_restarts=3, max_seconds=None):
+    partial = destination + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    report = {'pages': 0, 'steps': 0, 'lock': 0.0, 'max_lock': 0.0,
+              'restarts': 0, 'remaining': None}
+    step_start = [time.perf_counter()]
+    start = time.perf_counter()
+
+    def record_step(remaining, total):
+        held = time.perf_counter() - step_start[0]
+        report['steps'] += 1
+        report['pages'] = total
+        report['lock'] += held
+        report['max_lock'] = max(report['max_lock'], held)
+        if progress is not None:
+            progress(total - remaining, total)
+
+    def on_step(status, remaining, total):
+        record_step(remaining, total)
+        # fewer pages are left after every step, unless it started over
+        if report['remaining'] is not None and \
+                remaining > report['remaining']:
+            report['restarts'] += 1
+        report['remaining'] = remaining
+        if remaining and (report['restarts'] > max_restarts or (
+                max_seconds is not None and
+                time.perf_counter() - start > max_seconds)):
+            raise _GiveUpSteps()
+        if remaining and pause:
+            time.sleep(pause)
+        step_start[0] = time.perf_counter()
+
+    single_step = False
+    source_connection = sqlite3.connect(source, timeout=5)
+    target_connection = sqlite3.connect(partial)
+    try:
+        step_start[0] = time.perf_counter()
+        try:
+            source_connection.backup(target_connection, pages=pages,
+                                     progress=on_step)
+        except _GiveUpSteps:
+            single_step = True
+            step_start[0] = time.perf_counter()
+            source_connection.backup(
+                target_connection,
+                progress=lambda status, remaining, total: record_step(
+                    remaining, total))
+    finally:
+        target_connection.close()
+        source_connection.close()
+    os.replace(partial, destination)
+    return BackupReport(destination, report['pages'], report['steps'],
+                        time.perf_counter() - start, report['lock'],
+                        report['max_lock'], report['restarts'], single_step)
+
+
+'''
+restore(snapshot, database)
+    loads the snapshot into database in a single step, replacing all of
+    its content, i.e. to start a warm standby from the latest backup
+    other connections wait for the write lock meanwhile
+    a running server keeps serving its cached menu, restore before it
+    starts or invalidate the menu cache afterwards
+    returns the time it took in seconds
+'''
+
+
+def restore(snapshot, database):
+    start = time.perf_counter()
+    source_connection = sqlite3.connect(snapshot)
+    target_connection = sqlite3.connect(database, timeout=30)
+    try:
+        source_connection.backup(target_connection)
+    finally:
+        target_connection.close()
+        source_connection.close()
+    return time.perf_counter() - start
+
+
+'''
+BackupScheduler(source, directory, interval, keep)
+    backs source up into directory every `interval` seconds from a
+    daemon thread, keeping the `keep` most recent snapshots
+    snapshots are named <name>-<utc timestamp>.db
+    last_report holds the report of the last backup, failures counts the
+    backups that raised, last_error the last exception
+'''
+
+
+class BackupScheduler:
+    def __init__(self, source, directory, interval=3600, keep=24,
+                 **backup_options):
+        self.source = source
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self.backup_options = backup_options
+        self.last_report = None
+        self.last_error = None
+        self.failures = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='database-backup')
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run_once(self):
+        name = os.path.splitext(os.path.basename(self.source))[0]
+        destination = os.path.join(self.directory, '{}-{}.db'.format(
+            name, time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())))
+        self.last_report = backup(self.source, destination,
+                                  **self.backup_options)
+        self.prune(name)
+        return self.last_report
+
+    def prune(self, name):
+        snapshots = sorted(
+            f for f in os.listdir(self.directory)
+            if f.startswith(name + '-') and f.endswith('.db'))
+        for f in snapshots[:max(0, len(snapshots) - self.keep)]:
+            os.remove(os.path.join(self.directory, f))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as error:
+                self.failures += 1
+                self.last_error = error
+
+
+def database_file(database_uri):
+    return make_url(database_uri).database
+
+
+def main(argv=None):
+    from .models import database_path
+    parser = argparse.ArgumentParser(description='sqlite online backups')
+    commands = parser.add_subparsers(dest='command')
+    backup_parser = commands.add_parser('backup', help='write a snapshot')
+    backup_parser.add_argument('destination')
+    backup_parser.add_argument('--pages', type=int, default=256,
+                               help='pages copied per step')
+    backup_parser.add_argument('--pause', type=float, default=0.005,
+                               help='seconds slept between steps')
+    backup_parser.add_argument('--max-restarts', type=int, default=3,
+                               help='restarts before copying in one step')
+    backup_parser.add_argument('--max-seconds', type=float, default=None,
+                               help='seconds before copying in one step')
+    restore_parser = commands.add_parser(
+        'restore', help='replace the database with a snapshot')
+    restore_parser.add_argument('snapshot')
+    for command in (backup_parser, restore_parser):
+        command.add_argument('--database', default=database_file(
+            database_path), help='the sqlite database file')
+    args = parser.parse_args(argv)
+
+    if args.command == 'backup':
+        def progress(copied, total):
+            print('\rcopied {}/{} pages'.format(copied, total), end='')
+
+        report = backup(args.database, args.destination, pages=args.pages,
+                        pause=args.pause, progress=progress,
+                        max_restarts=args.max_restarts,
+                        max_seconds=args.max_seconds)
+        print('\n{}: {} pages in {} steps, {:.3f}s, lock held {:.3f}s '
+              '(longest step {:.3f}s), {} restarts{}'.format(
+                  report.path, report.pages, report.steps, report.seconds,
+                  report.lock_seconds, report.max_lock_seconds,
+                  report.restarts,
+                  ', finished in one step' if report.single_step else ''))
+    elif args.command == 'restore':
+        seconds = restore(args.snapshot, args.database)
+        print('restored {} into {} in {:.3f}s'.format(
+            args.snapshot, args.database, seconds))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+import hashlib
+import threading
+from collections import namedtuple
+
+
+MenuEntry = namedtuple('MenuEntry', ['body', 'etag'])
+
+'''
+SingleFlight
+    runs a function once per key at a time
+    the first caller for a key computes the result, callers arriving while
+    it runs wait for it and share the result (or the exception) instead of
+    computing it again
+    counts the calls made and the calls coalesced into another one
+'''
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+            return flight.result
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._flights)
+            }
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+'''
+MenuCache
+    keeps fully serialized menu response bodies (bytes) per form
+    ('short', 'long', ...) for the current menu version, together with
+    a strong etag derived from the body, so it is stable across workers
+    every write to the drinks table bumps the version through
+    invalidate(), which drops all bodies at once
+    concurrent misses for the same body are coalesced, only one of them
+    queries the database
+    the version is per process, each worker invalidates its own cache
+'''
+
+
+class MenuCache:
+    def __init__(self):
+        self.version = 0
+        self.flights = SingleFlight()
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    '''
+    get(form, build)
+        returns the cached MenuEntry for form
+        on a miss build() is called and its result is cached, unless
+        the menu changed while it was being built
+        build() returns the body bytes or None when there is no menu
+    '''
+
+    def get(self, form, build):
+        entry = self._entries.get(form)
+        if entry is not None:
+            return entry
+        version = self.version
+        return self.flights.do((form, version),
+                               lambda: self._build(form, version, build))
+
+    def _build(self, form, version, build):
+        entry = self.entry(build())
+        with self._lock:
+            if version == self.version:
+                self._entries[form] = entry
+        return entry
+
+    @staticmethod
+    def entry(body):
+        if body is None:
+            return MenuEntry(None, None)
+        return MenuEntry(body, hashlib.sha1(body).hexdigest())
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._entries = {}
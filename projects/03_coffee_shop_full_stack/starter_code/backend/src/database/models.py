@@ -1,14 +1,83 @@
 import os
-from sqlalchemy import Column, String, Integer
-from flask_sqlalchemy import SQLAlchemy
+import sqlite3
+from sqlalchemy import Column, String, Integer, ForeignKey, bindparam, \
+    event, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.pool import QueuePool
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
+from .cache import MenuCache
+from .tenants import TenantEngines, TenantLocal, current_tenant
+
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
 database_path = "sqlite:///{}".format(
     os.path.join(project_dir, database_filename))
 
-db = SQLAlchemy()
+'''
+TenantSession
+    routes every query of a request with a tenant to the tenant's own
+    database, see use_tenant_databases()
+    requests without a tenant use the app database
+'''
+
+
+class TenantSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        tenant = current_tenant()
+        if tenant is not None and tenant_engines.enabled:
+            return tenant_engines.get(tenant)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class TenantSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=TenantSession, db=self, **options)
+
+
+db = TenantSQLAlchemy()
+tenant_engines = TenantEngines()
+# one menu cache per tenant, menu_cache serves requests without a tenant
+menu_caches = TenantLocal(MenuCache)
+menu_cache = menu_caches.default
+# a tenant's cached menu goes with its engine
+tenant_engines.on_evict.append(menu_caches.discard)
+
+'''
+SQLITE_PROFILE
+    performance settings for the sqlite database
+    pragmas are applied to every new connection:
+        WAL lets readers keep reading while a write commits
+        synchronous NORMAL is durable in WAL mode without an fsync per commit
+        busy_timeout (ms) makes writers wait for the lock instead of failing
+        cache_size (negative: KiB) and mmap_size (bytes) keep hot pages in
+        memory
+    engine_options replace Flask-SQLAlchemy's default NullPool for sqlite
+    files with a pool of reusable connections shared between threads
+'''
+
+SQLITE_PROFILE = {
+    'pragmas': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'cache_size': -16000,
+        'mmap_size': 128 * 1024 * 1024,
+        'temp_store': 'MEMORY'
+    },
+    'engine_options': {
+        'poolclass': QueuePool,
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 10,
+        'connect_args': {'check_same_thread': False, 'timeout': 5}
+    }
+}
+
+# pragmas of the active profile, see use_sqlite_profile()
+sqlite_pragmas = {}
 
 '''
 setup_db(app)
@@ -16,13 +85,71 @@ setup_db(app)
 '''
 
 
-def setup_db(app):
+def setup_db(app, database_path=database_path, sqlite_profile=SQLITE_PROFILE):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    use_sqlite_profile(app, sqlite_profile)
     db.app = app
     db.init_app(app)
 
 
+'''
+use_sqlite_profile(app, sqlite_profile)
+    applies a profile shaped like SQLITE_PROFILE
+    engine options only affect engines created afterwards, an empty
+    profile restores the sqlite defaults
+'''
+
+
+def use_sqlite_profile(app, sqlite_profile):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(
+        sqlite_profile.get('engine_options', {}))
+    sqlite_pragmas.clear()
+    sqlite_pragmas.update(sqlite_profile.get('pragmas', {}))
+
+
+'''
+use_tenant_databases(app, directory, max_engines)
+    stores every tenant in its own sqlite file in directory, only the
+    tenants created with create_tenant() exist
+    at most max_engines tenant databases are kept open
+    the engines use the engine options of the active sqlite profile
+'''
+
+
+def use_tenant_databases(app, directory, max_engines=16):
+    os.makedirs(directory, exist_ok=True)
+    tenant_engines.configure(
+        directory, maxsize=max_engines,
+        engine_options=app.config.get("SQLALCHEMY_ENGINE_OPTIONS"),
+        on_open=db.Model.metadata.create_all)
+
+
+'''
+create_tenant(tenant)
+    creates the database of a new tenant with the current tables, does
+    nothing if it already exists
+    returns the path of the database file
+'''
+
+
+def create_tenant(tenant):
+    if not tenant_engines.enabled:
+        raise RuntimeError('tenant databases are not enabled')
+    tenant_engines.get(tenant, create=True)
+    return tenant_engines.path(tenant)
+
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in sqlite_pragmas.items():
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+
 '''
 db_drop_and_create_all()
     drops the database tables and starts fresh
@@ -34,6 +161,79 @@ db_drop_and_create_all()
 def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
+    menu_caches.current().invalidate()
+
+
+'''
+upgrade_db()
+    brings a database created by an older version of the models up to
+    date, every step does nothing if it was already applied
+    drinks written before change versions existed get a version of their
+    own, so a delta sync from 0 returns them
+'''
+
+
+def upgrade_db():
+    migrate_recipe_blobs()
+    columns = [row[1] for row in
+               db.session.execute('PRAGMA table_info(drink)')]
+    if 'version' not in columns:
+        db.session.execute('ALTER TABLE drink ADD COLUMN version INTEGER '
+                           'NOT NULL DEFAULT 0')
+        db.session.execute('CREATE INDEX ix_drink_version ON drink (version)')
+        db.session.commit()
+    unversioned = [drink_id for drink_id, in db.session.execute(
+        'SELECT id FROM drink WHERE version = 0 ORDER BY id')]
+    if unversioned:
+        first_version = ChangeCounter.reserve(len(unversioned)) - \
+            len(unversioned)
+        drink = Drink.__table__
+        db.session.execute(
+            drink.update().where(drink.c.id == bindparam('drink_id'))
+            .values(version=bindparam('new_version')),
+            [{'drink_id': drink_id, 'new_version': first_version + i + 1}
+             for i, drink_id in enumerate(unversioned)])
+        db.session.commit()
+    menu_caches.current().invalidate()
+
+
+'''
+migrate_recipe_blobs()
+    moves recipes stored by older versions as a json blob in
+    drink.recipe into the ingredient table and drops the blob column
+    does nothing on a database that is already migrated
+'''
+
+
+def migrate_recipe_blobs():
+    columns = [row[1] for row in
+               db.session.execute('PRAGMA table_info(drink)')]
+    if 'recipe' not in columns:
+        db.create_all()
+        return
+    db.session.execute('ALTER TABLE drink RENAME TO drink_blob')
+    db.session.commit()
+    db.create_all()
+    db.session.execute(
+        'INSERT INTO drink (id, title) SELECT id, title FROM drink_blob')
+    ingredients = []
+    for drink_id, recipe in db.session.execute(
+            'SELECT id, recipe FROM drink_blob'):
+        recipe = json.loads(recipe)
+        if isinstance(recipe, dict):
+            recipe = [recipe]
+        ingredients.extend({
+            'drink_id': drink_id,
+            'position': position,
+            'color': r['color'],
+            'name': r.get('name', ''),
+            'parts': r['parts']
+        } for position, r in enumerate(recipe))
+    if ingredients:
+        db.session.execute(Ingredient.__table__.insert(), ingredients)
+    db.session.execute('DROP TABLE drink_blob')
+    db.session.commit()
+    menu_caches.current().invalidate()
 
 
 '''
@@ -47,10 +247,35 @@ class Drink(db.Model):
     id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
     # String Title
     title = Column(String(80), unique=True)
-    # the ingredients blob - this stores a lazy json blob
-    # the required datatype is [{'color': string, 'name':string,
-    # 'parts':number}]
-    recipe = Column(String(180), nullable=False)
+    # change version of the last insert or update, see ChangeCounter
+    version = Column(Integer, nullable=False, server_default='0',
+                     index=True)
+    # the ingredients of the recipe, in order
+    ingredients = relationship('Ingredient', order_by='Ingredient.position',
+                               cascade='all, delete-orphan')
+
+    '''
+    recipe
+        the recipe as a list of ingredient dicts
+        the required datatype is [{'color': string, 'name':string,
+        'parts':number}], a single ingredient dict is accepted as well
+        assigning a recipe replaces all ingredients of the drink
+    '''
+
+    @property
+    def recipe(self):
+        return [ingredient.long() for ingredient in self.ingredients]
+
+    @recipe.setter
+    def recipe(self, recipe):
+        if isinstance(recipe, dict):
+            recipe = [recipe]
+        self.ingredients = [Ingredient(
+            position=position,
+            color=r['color'],
+            name=r.get('name', ''),
+            parts=r['parts']
+        ) for position, r in enumerate(recipe)]
 
     '''
     short()
@@ -58,17 +283,10 @@ class Drink(db.Model):
     '''
 
     def short(self):
-        print(json.loads(self.recipe))
-        data = json.loads(self.recipe)
-        if(isinstance(data, dict)):
-            short_recipe = [{'color': data['color'], 'parts': data['parts']}]
-        else:
-            short_recipe = [{'color': r['color'], 'parts': r['parts']}
-                            for r in json.loads(self.recipe)]
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': short_recipe
+            'recipe': [ingredient.short() for ingredient in self.ingredients]
         }
 
     '''
@@ -80,7 +298,7 @@ class Drink(db.Model):
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': json.loads(self.recipe)
+            'recipe': self.recipe
         }
 
     '''
@@ -88,32 +306,46 @@ class Drink(db.Model):
         inserts a new model into a database
         the model must have a unique name
         the model must have a unique id or null id
+        records a new change version and invalidates the cached menu
         EXAMPLE
             drink = Drink(title=req_title, recipe=req_recipe)
             drink.insert()
     '''
 
     def insert(self):
+        self.version = ChangeCounter.reserve()
         db.session.add(self)
+        db.session.flush()
+        # a reused id is alive again
+        DrinkTombstone.query.filter_by(drink_id=self.id).delete()
         db.session.commit()
+        menu_caches.current().invalidate()
 
     '''
     delete()
         deletes a new model into a database
         the model must exist in the database
+        leaves a tombstone with a new change version for delta sync and
+        invalidates the cached menu
+        returns the change version of the deletion
         EXAMPLE
             drink = Drink(title=req_title, recipe=req_recipe)
             drink.delete()
     '''
 
     def delete(self):
+        version = ChangeCounter.reserve()
+        db.session.merge(DrinkTombstone(drink_id=self.id, version=version))
         db.session.delete(self)
         db.session.commit()
+        menu_caches.current().invalidate()
+        return version
 
     '''
     update()
         updates a new model into a database
         the model must exist in the database
+        records a new change version and invalidates the cached menu
         EXAMPLE
             drink = Drink.query.filter(Drink.id == id).one_or_none()
             drink.title = 'Black Coffee'
@@ -121,7 +353,256 @@ class Drink(db.Model):
     '''
 
     def update(self):
+        self.version = ChangeCounter.reserve()
         db.session.commit()
+        menu_caches.current().invalidate()
+
+    '''
+    insert_many(drinks)
+        inserts many drinks in a single transaction
+        drinks is a list of (title, recipe) pairs, titles must be unique
+        the rows of each table are written with a single executemany
+        every drink gets its own change version
+        returns the ids of the new drinks in the order they were given
+        EXAMPLE
+            ids = Drink.insert_many([('Black Coffee', recipe)])
+    '''
+
+    @staticmethod
+    def insert_many(drinks):
+        if not drinks:
+            return []
+        try:
+            first_version = ChangeCounter.reserve(len(drinks)) - len(drinks)
+            before = db.session.query(db.func.max(Drink.id)).scalar() or 0
+            db.session.execute(Drink.__table__.insert(), [
+                {'title': title, 'version': first_version + i + 1}
+                for i, (title, _) in enumerate(drinks)])
+            # titles are unique, the new rows are found by title among the
+            # rows created after `before`
+            ids = dict(db.session.query(Drink.title, Drink.id)
+                       .filter(Drink.id > before))
+            DrinkTombstone.query.filter(
+                DrinkTombstone.drink_id > before).delete()
+            ingredients = []
+            for title, recipe in drinks:
+                if isinstance(recipe, dict):
+                    recipe = [recipe]
+                ingredients.extend({
+                    'drink_id': ids[title],
+                    'position': position,
+                    'color': r['color'],
+                    'name': r.get('name', ''),
+                    'parts': r['parts']
+                } for position, r in enumerate(recipe))
+            if ingredients:
+                db.session.execute(Ingredient.__table__.insert(), ingredients)
+            db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            raise
+        menu_caches.current().invalidate()
+        return [ids[title] for title, _ in drinks]
+
+    '''
+    existing_titles(titles)
+        returns the subset of titles already used by a drink
+    '''
+
+    @staticmethod
+    def existing_titles(titles, chunk_size=500):
+        titles = list(titles)
+        existing = set()
+        for i in range(0, len(titles), chunk_size):
+            chunk = titles[i:i + chunk_size]
+            existing.update(title for title, in db.session.query(Drink.title)
+                            .filter(Drink.title.in_(chunk)))
+        return existing
 
     def __repr__(self):
         return json.dumps(self.short())
+
+
+'''
+Ingredient
+a single ingredient of a drink recipe, extends the base SQLAlchemy Model
+'''
+
+
+class Ingredient(db.Model):
+    id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
+    drink_id = Column(Integer, ForeignKey('drink.id', ondelete='CASCADE'),
+                      nullable=False, index=True)
+    # order of the ingredient within the recipe
+    position = Column(Integer, nullable=False)
+    color = Column(String(80), nullable=False)
+    name = Column(String(80), nullable=False, default='')
+    parts = Column(Integer, nullable=False)
+
+    def short(self):
+        return {'color': self.color, 'parts': self.parts}
+
+    def long(self):
+        return {'color': self.color, 'name': self.name, 'parts': self.parts}
+
+    '''
+    recipes(first_drink_id, last_drink_id, form)
+        returns {drink_id: recipe} for the drinks with ids between
+        first_drink_id and last_drink_id, in the 'short' or 'long' form
+        only the needed columns are selected, with one range query on
+        the drink_id index
+    '''
+
+    @staticmethod
+    def recipes(first_drink_id, last_drink_id, form):
+        columns = [Ingredient.drink_id, Ingredient.color, Ingredient.parts]
+        if form == 'long':
+            columns.append(Ingredient.name)
+        rows = db.session.query(*columns) \
+            .filter(Ingredient.drink_id.between(first_drink_id,
+                                                last_drink_id)) \
+            .order_by(Ingredient.drink_id, Ingredient.position)
+        recipes = {}
+        for row in rows:
+            ingredient = {'color': row.color, 'parts': row.parts}
+            if form == 'long':
+                ingredient['name'] = row.name
+            recipes.setdefault(row.drink_id, []).append(ingredient)
+        return recipes
+
+
+'''
+DrinkRow
+a read-only drink for serialization, loaded as plain rows
+no ORM instances are built, so there is no identity map, session or
+attribute bookkeeping per drink
+'''
+
+
+class DrinkRow:
+    __slots__ = ('id', 'title', 'ingredients')
+
+    def __init__(self, id, title, ingredients):
+        self.id = id
+        self.title = title
+        # (color, name, parts) tuples in recipe order
+        self.ingredients = ingredients
+
+    '''
+    load()
+        returns all drinks ordered by id, with one query for the drinks
+        and one for all their ingredients
+    '''
+
+    @staticmethod
+    def load():
+        drink = Drink.__table__.c
+        ingredient = Ingredient.__table__.c
+        drinks = db.session.execute(
+            select([drink.id, drink.title]).order_by(drink.id)).fetchall()
+        recipes = {}
+        for drink_id, color, name, parts in db.session.execute(
+                select([ingredient.drink_id, ingredient.color,
+                        ingredient.name, ingredient.parts])
+                .order_by(ingredient.drink_id, ingredient.position)):
+            recipes.setdefault(drink_id, []).append((color, name, parts))
+        return [DrinkRow(drink_id, title, recipes.get(drink_id, []))
+                for drink_id, title in drinks]
+
+    '''
+    stream(batch_size)
+        yields all drinks ordered by id from a single cursor over drinks
+        joined with their ingredients, fetching batch_size rows at a time
+        so memory stays bounded whatever the size of the menu
+    '''
+
+    @staticmethod
+    def stream(batch_size=500):
+        drink = Drink.__table__.c
+        ingredient = Ingredient.__table__.c
+        query = select([drink.id, drink.title, ingredient.color,
+                        ingredient.name, ingredient.parts]) \
+            .select_from(Drink.__table__.outerjoin(Ingredient.__table__)) \
+            .order_by(drink.id, ingredient.position) \
+            .execution_options(stream_results=True)
+        result = db.session.execute(query)
+        current = None
+        try:
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for drink_id, title, color, name, parts in rows:
+                    if current is None or current.id != drink_id:
+                        if current is not None:
+                            yield current
+                        current = DrinkRow(drink_id, title, [])
+                    if color is not None:
+                        current.ingredients.append((color, name, parts))
+        finally:
+            result.close()
+        if current is not None:
+            yield current
+
+    def short(self):
+        return {
+            'id': self.id,
+            'title': self.title,
+            'recipe': [{'color': color, 'parts': parts}
+                       for color, _, parts in self.ingredients]
+        }
+
+    def long(self):
+        return {
+            'id': self.id,
+            'title': self.title,
+            'recipe': [{'color': color, 'name': name, 'parts': parts}
+                       for color, name, parts in self.ingredients]
+        }
+
+
+'''
+ChangeCounter
+the single row holding the last change version handed out
+versions increase with every insert, update and delete of a drink, so
+clients can ask for everything that changed after the version they saw
+'''
+
+
+class ChangeCounter(db.Model):
+    __tablename__ = 'change_counter'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+    '''
+    reserve(count)
+        reserves count new versions in the current transaction and
+        returns the last one
+        the counter is bumped before it is read, which takes the sqlite
+        write lock, so versions are committed in increasing order
+    '''
+
+    @staticmethod
+    def reserve(count=1):
+        counter = ChangeCounter.__table__
+        result = db.session.execute(update(counter).values(
+            version=counter.c.version + count))
+        if result.rowcount == 0:
+            db.session.execute(counter.insert().values(id=1, version=count))
+        return db.session.execute(select([counter.c.version])).scalar()
+
+    @staticmethod
+    def current():
+        return db.session.query(ChangeCounter.version).scalar() or 0
+
+
+'''
+DrinkTombstone
+the id and change version of a deleted drink, kept for delta sync
+'''
+
+
+class DrinkTombstone(db.Model):
+    __tablename__ = 'drink_tombstone'
+    drink_id = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(Integer, nullable=False, index=True)
@@ -0,0 +1,184 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from flask import _request_ctx_stack
+from sqlalchemy import create_engine
+
+
+# tenant ids become file names, only a safe subset is accepted
+TENANT_ID = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$')
+
+
+def valid_tenant(tenant):
+    return isinstance(tenant, str) and bool(TENANT_ID.match(tenant))
+
+
+'''
+current_tenant()
+    the tenant selected for the current request, kept on the request
+    context, or None outside a request or when no tenant was selected
+    flask.g is not used: it belongs to the app context, which can outlive
+    the request and would route the next request to the same tenant
+'''
+
+
+def current_tenant():
+    return getattr(_request_ctx_stack.top, 'tenant', None)
+
+
+def set_tenant(tenant):
+    if not valid_tenant(tenant):
+        raise ValueError('invalid tenant id: {!r}'.format(tenant))
+    ctx = _request_ctx_stack.top
+    if ctx is None:
+        raise RuntimeError('set_tenant() needs a request context')
+    ctx.tenant = tenant
+
+
+class UnknownTenant(LookupError):
+    '''the tenant has no database, see TenantEngines.get()'''
+
+
+'''
+TenantEngines
+    a bounded pool of engines, one per tenant sqlite file
+    <directory>/<tenant>.db
+    each shop writes to its own file, so writes of different shops do not
+    wait for the same database lock
+    engines are opened on first use, the least recently used engine is
+    disposed once more than `maxsize` are open
+    get(tenant) only opens files that exist and raises UnknownTenant
+    otherwise, get(tenant, create=True) provisions a new tenant
+    on_open(engine) runs when an engine is opened, i.e. to create the
+    tables of a new tenant
+    every function of on_evict is called with the tenant of an engine
+    that was disposed, i.e. to drop the tenant's cached objects
+    disabled until configure() is called
+'''
+
+
+class TenantEngines:
+    def __init__(self, maxsize=16):
+        self.directory = None
+        self.maxsize = maxsize
+        self.engine_options = {}
+        self.on_open = None
+        self.on_evict = []
+        self.opened = 0
+        self.evicted = 0
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def configure(self, directory, maxsize=None, engine_options=None,
+                  on_open=None):
+        self.dispose()
+        self.directory = directory
+        if maxsize is not None:
+            self.maxsize = maxsize
+        self.engine_options = dict(engine_options or {})
+        self.on_open = on_open
+        self.opened = 0
+        self.evicted = 0
+
+    def path(self, tenant):
+        if not valid_tenant(tenant):
+            raise ValueError('invalid tenant id: {!r}'.format(tenant))
+        return os.path.join(self.directory, tenant + '.db')
+
+    def exists(self, tenant):
+        return os.path.exists(self.path(tenant))
+
+    def get(self, tenant, create=False):
+        with self._lock:
+            engine = self._engines.get(tenant)
+            if engine is not None:
+                self._engines.move_to_end(tenant)
+                return engine
+            # sqlite creates missing files on connect
+            if not create and not self.exists(tenant):
+                raise UnknownTenant(tenant)
+            # opened under the lock, so a tenant never gets two engines
+            engine = create_engine('sqlite:///' + self.path(tenant),
+                                   **self.engine_options)
+            if self.on_open is not None:
+                self.on_open(engine)
+            self._engines[tenant] = engine
+            self.opened += 1
+            while len(self._engines) > self.maxsize:
+                evicted_tenant, evicted = self._engines.popitem(last=False)
+                # connections still checked out are closed when returned
+                evicted.dispose()
+                self.evicted += 1
+                self._evicted(evicted_tenant)
+            return engine
+
+    def dispose(self):
+        with self._lock:
+            for tenant, engine in self._engines.items():
+                engine.dispose()
+                self._evicted(tenant)
+            self._engines.clear()
+
+    def _evicted(self, tenant):
+        for on_evict in self.on_evict:
+            on_evict(tenant)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'open': len(self._engines),
+                'maxsize': self.maxsize,
+                'opened': self.opened,
+                'evicted': self.evicted
+            }
+
+
+'''
+TenantLocal(factory, in_use)
+    one object per tenant, i.e. a menu cache or an event broadcaster
+    `default` serves requests without a tenant, current() returns the
+    object of the current request's tenant, created on first use
+    discard(tenant) drops the object of a tenant, i.e. when its engine is
+    evicted, unless in_use(object) is true
+'''
+
+
+class TenantLocal:
+    def __init__(self, factory, in_use=None):
+        self.factory = factory
+        self.in_use = in_use
+        self.default = factory()
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def current(self):
+        tenant = current_tenant()
+        if tenant is None:
+            return self.default
+        return self.get(tenant)
+
+    def get(self, tenant):
+        value = self._objects.get(tenant)
+        if value is None:
+            with self._lock:
+                value = self._objects.get(tenant)
+                if value is None:
+                    value = self._objects[tenant] = self.factory()
+        return value
+
+    def discard(self, tenant):
+        with self._lock:
+            value = self._objects.get(tenant)
+            if value is not None and not (
+                    self.in_use is not None and self.in_use(value)):
+                del self._objects[tenant]
+
+    def all(self):
+        with self._lock:
+            return [self.default] + list(self._objects.values())
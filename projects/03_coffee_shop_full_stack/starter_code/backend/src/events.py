@@ -0,0 +1,139 @@
+import bisect
+import json
+import threading
+import time
+
+
+'''
+EventBroadcaster
+    an in-process server-sent events hub
+    publish() serializes an event once, every subscriber then writes the
+    same bytes, idle subscribers sleep on a shared condition and wake up
+    for new events or to send a heartbeat comment
+    event ids are the drink change versions, which are contiguous, so a
+    client reconnecting with Last-Event-ID is replayed what it missed
+    from the last `history` events, or told to resync when they are gone
+    versions are reserved inside the write transactions but published
+    after they commit, so concurrent writers can publish them out of
+    order: the history is kept in id order and a subscriber is only sent
+    the events following the last one it got, without gaps
+    an id missing for `gap_timeout` seconds, i.e. written by another
+    process, is given up with a 'reset' event
+    only writes made by this process are broadcast
+'''
+
+
+class EventBroadcaster:
+    def __init__(self, history=1000, heartbeat=15, retry=3000,
+                 gap_timeout=2):
+        self.history = history
+        self.heartbeat = heartbeat
+        self.retry = retry
+        self.gap_timeout = gap_timeout
+        self.subscribers = 0
+        # (event_id, data, time.monotonic() of the publish), by event_id
+        self._events = []
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def format(event_id, event, data):
+        return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+            event_id, event, json.dumps(data)).encode('utf-8')
+
+    '''
+    publish(events)
+        broadcasts (event_id, event, data) tuples, ids published earlier
+        by another writer can follow
+    '''
+
+    def publish(self, events):
+        now = time.monotonic()
+        encoded = [(event_id, self.format(event_id, event, data), now)
+                   for event_id, event, data in events]
+        with self._condition:
+            for event in encoded:
+                bisect.insort(self._events, event)
+            del self._events[:-self.history]
+            self._condition.notify_all()
+
+    def clear(self):
+        with self._condition:
+            self._events.clear()
+
+    def latest_id(self):
+        with self._condition:
+            return self._events[-1][0] if self._events else None
+
+    '''
+    subscribe(last_event_id, current_id)
+        yields the event stream for one client
+        last_event_id is the Last-Event-ID sent by a reconnecting client,
+        current_id the latest change version in the database
+        when events after last_event_id are no longer available a
+        'reset' event with {"since": last_event_id} is sent first, the
+        client then catches up through GET /drinks/changes
+    '''
+
+    def subscribe(self, last_event_id=None, current_id=None):
+        reset = None
+        if last_event_id is None:
+            last_event_id = max(self.latest_id() or 0, current_id or 0)
+        elif not self._can_replay(last_event_id, current_id):
+            reset = self.format(last_event_id, 'reset',
+                                {'since': last_event_id})
+            last_event_id = max(self.latest_id() or 0, current_id or 0)
+        return self._stream(last_event_id, reset)
+
+    def _stream(self, last_event_id, reset):
+        with self._condition:
+            self.subscribers += 1
+        try:
+            yield 'retry: {}\n\n'.format(self.retry).encode('utf-8')
+            if reset is not None:
+                yield reset
+            while True:
+                reset = None
+                with self._condition:
+                    pending, held_since = self._after(last_event_id)
+                    if not pending:
+                        timeout = self.heartbeat
+                        if held_since is not None:
+                            timeout = min(timeout, max(0, held_since +
+                                          self.gap_timeout - time.monotonic()))
+                        self._condition.wait(timeout)
+                        pending, held_since = self._after(last_event_id)
+                    if not pending and held_since is not None and \
+                            time.monotonic() - held_since >= self.gap_timeout:
+                        # the missing id never came, the client resyncs
+                        reset = self.format(last_event_id, 'reset',
+                                            {'since': last_event_id})
+                        last_event_id = self._events[-1][0]
+                if pending:
+                    last_event_id = pending[-1][0]
+                    yield b''.join(data for _, data in pending)
+                elif reset is not None:
+                    yield reset
+                else:
+                    yield b': heartbeat\n\n'
+        finally:
+            with self._condition:
+                self.subscribers -= 1
+
+    def _after(self, last_event_id):
+        # ([(event_id, data)] following last_event_id without a gap, the
+        # time the first event held back by a gap was published or None)
+        start = bisect.bisect_right(self._events, (last_event_id, b'\xff'))
+        pending = []
+        for event_id, data, published in self._events[start:]:
+            if event_id != last_event_id + len(pending) + 1:
+                held = self._events[start + len(pending):]
+                return pending, min(published for _, _, published in held)
+            pending.append((event_id, data))
+        return pending, None
+
+    def _can_replay(self, last_event_id, current_id):
+        with self._condition:
+            if current_id is not None and last_event_id >= current_id:
+                return True
+            return bool(self._events) and \
+                self._events[0][0] <= last_event_id + 1
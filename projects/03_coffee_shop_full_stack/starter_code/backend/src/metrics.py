@@ -0,0 +1,224 @@
+import threading
+import time
+from bisect import bisect_left
+
+from flask import abort, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+'''
+metrics
+    request timing for the coffee shop api, enabled with the
+    SERVER_TIMING config flag
+    timed(name) blocks and database queries add up per request into a
+    Server-Timing response header, the total duration of every request
+    feeds a latency histogram per route, exposed by GET /metrics in the
+    prometheus text format
+    when disabled no timing state is created, timed() returns a shared
+    no-op context manager and /metrics answers 404
+'''
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    '''
+    quantile(q)
+        estimates the q-quantile by linear interpolation inside the
+        bucket that holds it, like prometheus' histogram_quantile
+    '''
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, method, route, seconds):
+        with self._lock:
+            histogram = self.histograms.get((method, route))
+            if histogram is None:
+                histogram = self.histograms[(method, route)] = \
+                    LatencyHistogram()
+            histogram.observe(seconds)
+
+    def clear(self):
+        with self._lock:
+            self.histograms = {}
+
+    '''
+    exposition(extra)
+        renders the histograms, their estimated quantiles and the extra
+        {name: (type, help, value)} metrics in the prometheus text format
+    '''
+
+    def exposition(self, extra=None):
+        name = 'coffee_shop_request_duration_seconds'
+        lines = [
+            '# HELP {} Request latency by route.'.format(name),
+            '# TYPE {} histogram'.format(name)
+        ]
+        quantile_lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            for (method, route), histogram in histograms:
+                labels = 'method="{}",route="{}"'.format(method, route)
+                cumulative = 0
+                bounds = [repr(bound) for bound in histogram.buckets]
+                for bound, count in zip(bounds + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        name, labels, bound, cumulative))
+                lines.append('{}_sum{{{}}} {!r}'.format(
+                    name, labels, histogram.sum))
+                lines.append('{}_count{{{}}} {}'.format(
+                    name, labels, histogram.count))
+                for q in QUANTILES:
+                    quantile_lines.append(
+                        '{}_quantile{{{},quantile="{}"}} {!r}'.format(
+                            name, labels, q, histogram.quantile(q)))
+        lines.append('# HELP {}_quantile Estimated request latency '
+                     'quantiles by route.'.format(name))
+        lines.append('# TYPE {}_quantile gauge'.format(name))
+        lines.extend(quantile_lines)
+        for metric, (kind, description, value) in sorted(
+                (extra or {}).items()):
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            lines.append('{} {!r}'.format(metric, value))
+        return '\n'.join(lines) + '\n'
+
+
+route_metrics = RouteMetrics()
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_timing(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+def timing_active():
+    return has_request_context() and 'server_timing' in g
+
+
+'''
+timed(name)
+    context manager adding the time spent in its block to the `name`
+    entry of the current request's Server-Timing header
+'''
+
+
+def timed(name):
+    if timing_active():
+        return _Span(name)
+    return _no_span
+
+
+def add_timing(name, seconds):
+    timings = g.server_timing
+    timings[name] = timings.get(name, 0.0) + seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context,
+                   executemany):
+    if timing_active():
+        conn.info['query_start'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context,
+                    executemany):
+    start = conn.info.pop('query_start', None)
+    if start is not None and timing_active():
+        add_timing('db', time.perf_counter() - start)
+
+
+'''
+init_app(app, extra_metrics)
+    registers the timing hooks and the /metrics endpoint on app
+    extra_metrics() returns additional {name: (type, help, value)}
+    metrics for /metrics
+'''
+
+
+def init_app(app, extra_metrics=None):
+    app.config.setdefault('SERVER_TIMING', False)
+
+    @app.before_request
+    def start_timing():
+        if app.config['SERVER_TIMING']:
+            g.server_timing = {}
+            g.request_start = time.perf_counter()
+
+    @app.after_request
+    def finish_timing(response):
+        if 'server_timing' not in g:
+            return response
+        total = time.perf_counter() - g.request_start
+        timings = dict(g.server_timing, total=total)
+        response.headers['Server-Timing'] = ', '.join(
+            '{};dur={:.3f}'.format(name, seconds * 1000)
+            for name, seconds in timings.items())
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        route_metrics.observe(request.method, route, total)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        if not app.config['SERVER_TIMING']:
+            abort(404)
+        extra = extra_metrics() if extra_metrics else None
+        return app.response_class(route_metrics.exposition(extra),
+                                  mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,160 @@
+'''
+schema
+    request payload validation compiled ahead of time
+    a schema is a dict using a small subset of json schema:
+        type        'object', 'array', 'string' or 'integer'
+        required    keys an object must have
+        properties  {key: schema} for the keys of an object
+        items       schema of every item of an array
+        minItems    least number of items of an array
+        minLength, maxLength    bounds of a string's length
+    and two extensions:
+        blank       False rejects strings of only whitespace
+        single      True accepts a lone object where an array is expected
+    compile_schema() turns a schema into a chain of closures once, so
+    validating a payload does no schema lookups and stops at the first
+    error
+    EXAMPLE
+        validate = compile_schema({'type': 'object', 'required': ['title'],
+                                   'properties': {'title': {
+                                       'type': 'string'}}}, 'drink')
+        validate({'title': 1})  # 'title must be a string'
+'''
+
+
+class ValidationError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+TYPES = {
+    'object': (dict, 'an object'),
+    'array': (list, 'a list'),
+    'string': (str, 'a string'),
+    'integer': (int, 'an integer')
+}
+
+
+'''
+compile_schema(schema, name)
+    returns validate(value), which returns None when value matches the
+    schema, else a message naming the invalid field, i.e.
+    'recipe[1].parts must be an integer'
+    name is used for errors about the value itself
+'''
+
+
+def compile_schema(schema, name='body'):
+    check = _compile(schema)
+
+    def validate(value):
+        error = check(value)
+        if error is None:
+            return None
+        path, message = error
+        return '{} {}'.format(_field(path) or name, message)
+
+    return validate
+
+
+def _field(path):
+    field = ''
+    for part in path:
+        if isinstance(part, int):
+            field += '[{}]'.format(part)
+        else:
+            field += '.' + part if field else part
+    return field
+
+
+'''
+_compile(schema)
+    returns check(value), which returns None or a (path, message) error,
+    path being the keys and indexes leading to the invalid field
+'''
+
+
+def _compile(schema):
+    checks = []
+    kind = schema.get('type')
+    if kind is not None:
+        checks.append(_type_check(kind))
+    if 'minLength' in schema:
+        checks.append(_bound_check(
+            schema['minLength'], None, 'must be at least {} characters'))
+    if 'maxLength' in schema:
+        checks.append(_bound_check(
+            None, schema['maxLength'], 'must be at most {} characters'))
+    if schema.get('blank') is False:
+        checks.append(lambda value: None if value.strip() else
+                      ((), 'must not be blank'))
+    if 'minItems' in schema:
+        checks.append(_bound_check(
+            schema['minItems'], None, 'must have at least {} item(s)'))
+    if 'required' in schema or 'properties' in schema:
+        checks.append(_object_check(schema.get('required', ()),
+                                    schema.get('properties', {})))
+    if 'items' in schema:
+        checks.append(_items_check(_compile(schema['items'])))
+    single = schema.get('single', False)
+
+    def check(value):
+        if single and isinstance(value, dict):
+            value = [value]
+        for step in checks:
+            error = step(value)
+            if error is not None:
+                return error
+        return None
+
+    return check
+
+
+def _type_check(kind):
+    expected, description = TYPES[kind]
+    message = 'must be ' + description
+    if expected is int:
+        # bool is an int subclass, true is not a number of parts
+        return lambda value: None if isinstance(value, int) and \
+            not isinstance(value, bool) else ((), message)
+    return lambda value: None if isinstance(value, expected) else \
+        ((), message)
+
+
+def _bound_check(least, most, message):
+    if least is not None:
+        message = message.format(least)
+        return lambda value: None if len(value) >= least else ((), message)
+    message = message.format(most)
+    return lambda value: None if len(value) <= most else ((), message)
+
+
+def _object_check(required, properties):
+    required = tuple(required)
+    properties = [(key, _compile(schema))
+                  for key, schema in properties.items()]
+
+    def check(value):
+        for key in required:
+            if key not in value:
+                return (key,), 'is required'
+        for key, check_property in properties:
+            if key in value:
+                error = check_property(value[key])
+                if error is not None:
+                    return (key,) + error[0], error[1]
+        return None
+
+    return check
+
+
+def _items_check(check_item):
+    def check(value):
+        for index, item in enumerate(value):
+            error = check_item(item)
+            if error is not None:
+                return (index,) + error[0], error[1]
+        return None
+
+    return check
@@ -0,0 +1,901 @@
+import base64
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from Crypto.PublicKey import RSA
+from jose import jwt
+
+from src.api import app, menu_events
+from src.events import EventBroadcaster
+from src.auth import auth
+from src.auth.jwks import CircuitBreaker, JWKSCache
+from src.auth.permissions import all_of, any_of, compile_permission
+from src.auth.token_cache import VerifiedTokenCache
+from src.metrics import LatencyHistogram, route_metrics
+from sqlalchemy import event
+
+from src.database.backup import BackupScheduler, backup, database_file, \
+    restore
+from src.database.cache import MenuCache
+from src.database.models import db, Drink, DrinkRow, menu_cache, \
+    tenant_engines, upgrade_db, use_tenant_databases, create_tenant, \
+    menu_caches
+
+
+def b64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class IdentityProviderStub(BaseHTTPRequestHandler):
+    """Serves /hang slower than any fetch timeout and /error as a 500"""
+
+    def do_GET(self):
+        if self.path == '/hang':
+            time.sleep(1)
+        self.send_response(500)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class CoffeeShopTestCase(unittest.TestCase):
+    """This class represents the coffee shop test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.rsa_key = RSA.generate(2048)
+        cls.private_pem = cls.rsa_key.exportKey('PEM').decode()
+        cls.kid = 'test-key'
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.jwks_path = os.path.join(self.tmp_dir, 'jwks.json')
+        self.write_jwks([self.kid])
+        self.jwks_cache = auth.jwks_cache
+        auth.jwks_cache = JWKSCache('file://' + self.jwks_path)
+        self.token_cache = auth.token_cache
+        auth.token_cache = VerifiedTokenCache()
+
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(
+            os.path.join(self.tmp_dir, 'test.db'))
+        self.client = app.test_client
+        menu_events.clear()
+        with app.app_context():
+            db.create_all()
+            Drink(title='water', recipe=[
+                {'name': 'water', 'color': 'blue', 'parts': 1}]).insert()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        auth.jwks_cache = self.jwks_cache
+        auth.token_cache = self.token_cache
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.get_engine(app).dispose()
+        shutil.rmtree(self.tmp_dir)
+
+    def write_jwks(self, kids):
+        keys = [{
+            'kty': 'RSA',
+            'kid': kid,
+            'use': 'sig',
+            'n': b64url_uint(self.rsa_key.n),
+            'e': b64url_uint(self.rsa_key.e)
+        } for kid in kids]
+        with open(self.jwks_path, 'w') as f:
+            json.dump({'keys': keys}, f)
+
+    def token(self, permissions, kid=None, expires_in=3600, tenant=None):
+        claims = {
+            'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+            'aud': auth.API_AUDIENCE,
+            'sub': 'test|user',
+            'exp': int(time.time()) + expires_in,
+            'permissions': permissions
+        }
+        if tenant is not None:
+            claims['tenant'] = tenant
+        return jwt.encode(claims, self.private_pem, algorithm='RS256',
+                          headers={'kid': kid or self.kid})
+
+    def headers(self, permissions, **kwargs):
+        return {
+            'Authorization': 'Bearer ' + self.token(permissions, **kwargs)
+        }
+
+    def test_get_drinks(self):
+        res = self.client().get('/drinks')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['drinks'][0]['recipe'],
+                         [{'color': 'blue', 'parts': 1}])
+
+    def test_get_drinks_detail(self):
+        res = self.client().get(
+            '/drinks-detail', headers=self.headers(['get:drinks-detail']))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['drinks'][0]['recipe'][0]['name'], 'water')
+
+    def test_get_drinks_detail_without_permission(self):
+        res = self.client().get(
+            '/drinks-detail', headers=self.headers(['post:drinks']))
+        self.assertEqual(res.status_code, 403)
+
+    def test_get_drinks_detail_without_token(self):
+        res = self.client().get('/drinks-detail')
+        self.assertEqual(res.status_code, 401)
+
+    def test_jwks_is_fetched_once(self):
+        headers = self.headers(['get:drinks-detail'])
+        self.client().get('/drinks-detail', headers=headers)
+        os.remove(self.jwks_path)
+        res = self.client().get('/drinks-detail', headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_jwks_refreshes_on_unknown_kid(self):
+        self.client().get(
+            '/drinks-detail', headers=self.headers(['get:drinks-detail']))
+        self.write_jwks([self.kid, 'rotated-key'])
+        auth.jwks_cache.min_refresh_interval = 0
+        res = self.client().get('/drinks-detail', headers=self.headers(
+            ['get:drinks-detail'], kid='rotated-key'))
+        self.assertEqual(res.status_code, 200)
+
+    def test_jwks_unknown_kid(self):
+        res = self.client().get('/drinks-detail', headers=self.headers(
+            ['get:drinks-detail'], kid='unknown-key'))
+        self.assertEqual(res.status_code, 401)
+
+    def test_verified_token_is_cached(self):
+        headers = self.headers(['get:drinks-detail'])
+        self.client().get('/drinks-detail', headers=headers)
+        res = self.client().get('/drinks-detail', headers=headers)
+        stats = auth.token_cache.stats()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_expired_token_is_not_cached(self):
+        res = self.client().get('/drinks-detail', headers=self.headers(
+            ['get:drinks-detail'], expires_in=-10))
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(auth.token_cache.stats()['size'], 0)
+
+    def test_token_cache_is_bounded(self):
+        cache = VerifiedTokenCache(maxsize=2)
+        exp = time.time() + 60
+        for token in ('a', 'b', 'c'):
+            cache.set(token, {'exp': exp})
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), {'exp': exp})
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def start_identity_provider_stub(self):
+        server = HTTPServer(('127.0.0.1', 0), IdentityProviderStub)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:{}'.format(server.server_port)
+
+    def test_jwks_serves_stale_keys_when_provider_hangs(self):
+        cache = JWKSCache('file://' + self.jwks_path, ttl=0,
+                          min_refresh_interval=0, timeout=0.2,
+                          background=False)
+        self.assertIsNotNone(cache.get_key(self.kid))
+        cache.url = self.start_identity_provider_stub() + '/hang'
+        start = time.monotonic()
+        key = cache.get_key(self.kid)
+        self.assertLess(time.monotonic() - start, 0.9)
+        self.assertEqual(key['kid'], self.kid)
+
+    def test_jwks_breaker_opens_on_errors(self):
+        cache = JWKSCache(self.start_identity_provider_stub() + '/error',
+                          min_refresh_interval=0,
+                          breaker=CircuitBreaker(failure_threshold=2))
+        self.assertIsNone(cache.get_key(self.kid))
+        self.assertIsNone(cache.get_key(self.kid))
+        self.assertEqual(cache.breaker.state, CircuitBreaker.OPEN)
+        cache.url = 'file://' + self.jwks_path
+        self.assertIsNone(cache.get_key(self.kid))
+
+    def test_breaker_half_open_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_menu_is_served_from_cache(self):
+        self.client().get('/drinks')
+        with app.app_context():
+            db.session.execute('DELETE FROM drink')
+            db.session.commit()
+        res = self.client().get('/drinks')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(json.loads(res.data)['drinks']), 1)
+
+    def test_menu_cache_is_invalidated_on_write(self):
+        version = menu_cache.version
+        self.client().get('/drinks')
+        res = self.client().post('/drinks', headers=self.headers(
+            ['post:drinks']), json={
+                'title': 'tea',
+                'recipe': [{'name': 'tea', 'color': 'brown', 'parts': 1}]})
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(menu_cache.version, version)
+        res = self.client().get('/drinks')
+        self.assertEqual(len(json.loads(res.data)['drinks']), 2)
+
+    def test_get_drinks_not_modified(self):
+        res = self.client().get('/drinks')
+        etag = res.headers['ETag']
+        res = self.client().get('/drinks', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_get_drinks_etag_changes_with_menu(self):
+        etag = self.client().get('/drinks').headers['ETag']
+        with app.app_context():
+            Drink(title='tea', recipe=[
+                {'name': 'tea', 'color': 'brown', 'parts': 1}]).insert()
+        res = self.client().get('/drinks', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_drinks_detail_not_modified(self):
+        headers = self.headers(['get:drinks-detail'])
+        res = self.client().get('/drinks-detail', headers=headers)
+        headers['If-None-Match'] = res.headers['ETag']
+        res = self.client().get('/drinks-detail', headers=headers)
+        self.assertEqual(res.status_code, 304)
+
+    def count_queries(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = db.get_engine(app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute',
+                        before_cursor_execute)
+        return statements
+
+    def test_get_drinks_loads_ingredients_in_one_query(self):
+        with app.app_context():
+            for i in range(5):
+                Drink(title='drink {}'.format(i), recipe=[
+                    {'name': 'milk', 'color': 'white', 'parts': 1},
+                    {'name': 'coffee', 'color': 'brown', 'parts': 2}
+                ]).insert()
+            statements = self.count_queries()
+        res = self.client().get('/drinks')
+        self.assertEqual(len(json.loads(res.data)['drinks']), 6)
+        self.assertEqual(len(statements), 2)
+
+    def test_recipe_is_not_limited_in_length(self):
+        recipe = [{'name': 'ingredient {}'.format(i), 'color': 'blue',
+                   'parts': i} for i in range(20)]
+        res = self.client().post('/drinks', headers=self.headers(
+            ['post:drinks']), json={'title': 'big', 'recipe': recipe})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['drinks'][0]['recipe'], recipe)
+
+    def test_patch_drink_replaces_ingredients(self):
+        recipe = [{'name': 'tea', 'color': 'brown', 'parts': 2}]
+        res = self.client().patch('/drinks/1', headers=self.headers(
+            ['patch:drinks']), json={'title': 'tea', 'recipe': recipe})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['drinks'][0]['recipe'], recipe)
+
+    def test_invalid_drinks_are_rejected_before_database_work(self):
+        headers = self.headers(['post:drinks', 'patch:drinks'])
+        statements = self.count_queries()
+        for body, message in (
+                ({'recipe': []}, 'title is required'),
+                ({'title': '  ', 'recipe': {'color': 'red', 'parts': 1}},
+                 'title must not be blank'),
+                ({'title': 'tea', 'recipe': []},
+                 'recipe must have at least 1 item(s)'),
+                ({'title': 'tea', 'recipe': [
+                    {'color': 'red', 'parts': 1},
+                    {'color': 'red', 'parts': True}]},
+                 'recipe[1].parts must be an integer'),
+                ([], 'drink must be an object')):
+            res = self.client().post('/drinks', headers=headers, json=body)
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(json.loads(res.data)['message'], message)
+        res = self.client().patch('/drinks/1', headers=headers,
+                                  data='{not json')
+        self.assertEqual(json.loads(res.data)['message'],
+                         'drink must be an object')
+        self.assertEqual(statements, [])
+
+    def test_patch_missing_drink(self):
+        res = self.client().patch('/drinks/99', headers=self.headers(
+            ['patch:drinks']), json={'title': 'tea', 'recipe': [
+                {'color': 'brown', 'parts': 1}]})
+        self.assertEqual(res.status_code, 404)
+
+    def test_upgrade_db(self):
+        path = os.path.join(self.tmp_dir, 'legacy.db')
+        connection = sqlite3.connect(path)
+        connection.execute(
+            'CREATE TABLE drink (id INTEGER NOT NULL, title VARCHAR(80), '
+            'recipe VARCHAR(180) NOT NULL, PRIMARY KEY (id), UNIQUE (title))')
+        connection.executemany('INSERT INTO drink VALUES (?, ?, ?)', [
+            (3, 'fresh', json.dumps([
+                {'color': 'blue', 'name': 'cc', 'parts': 2},
+                {'name': '', 'color': 'yellow', 'parts': 1}])),
+            (8, 'water', json.dumps(
+                {'name': 'water', 'color': 'blue', 'parts': 1}))
+        ])
+        connection.commit()
+        connection.close()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+        with app.app_context():
+            upgrade_db()
+            upgrade_db()
+            drinks = [drink.long() for drink in Drink.query.order_by(Drink.id)]
+        self.assertEqual(drinks, [{
+            'id': 3,
+            'title': 'fresh',
+            'recipe': [{'color': 'blue', 'name': 'cc', 'parts': 2},
+                       {'color': 'yellow', 'name': '', 'parts': 1}]
+        }, {
+            'id': 8,
+            'title': 'water',
+            'recipe': [{'color': 'blue', 'name': 'water', 'parts': 1}]
+        }])
+        res = self.client().get('/drinks/changes?since=0')
+        data = json.loads(res.data)
+        self.assertEqual([d['id'] for d in data['drinks']], [3, 8])
+        self.assertEqual(data['version'], 2)
+
+    def test_add_drinks_bulk(self):
+        recipe = [{'name': 'milk', 'color': 'white', 'parts': 1}]
+        res = self.client().post('/drinks/bulk', headers=self.headers(
+            ['post:drinks']), json=[
+                {'title': 'latte', 'recipe': recipe},
+                {'title': 'water', 'recipe': recipe},
+                {'title': 'mocha'},
+                {'title': 'latte', 'recipe': recipe},
+                {'title': 'flat white', 'recipe': recipe}])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual([r['success'] for r in data['drinks']],
+                         [True, False, False, False, True])
+        with app.app_context():
+            drink = Drink.query.get(data['drinks'][4]['id'])
+            self.assertEqual(drink.title, 'flat white')
+            self.assertEqual(drink.recipe, recipe)
+
+    def test_add_drinks_bulk_ndjson(self):
+        lines = [json.dumps({'title': 'drink {}'.format(i), 'recipe': [
+            {'name': 'milk', 'color': 'white', 'parts': i + 1}]})
+            for i in range(3)] + ['{not json']
+        headers = self.headers(['post:drinks'])
+        headers['Content-Type'] = 'application/x-ndjson'
+        res = self.client().post('/drinks/bulk', headers=headers,
+                                 data='\n'.join(lines))
+        data = json.loads(res.data)
+        self.assertEqual(data['inserted'], 3)
+        self.assertFalse(data['drinks'][3]['success'])
+        res = self.client().get('/drinks')
+        self.assertEqual(len(json.loads(res.data)['drinks']), 4)
+
+    def test_add_drinks_bulk_requires_list(self):
+        res = self.client().post('/drinks/bulk', headers=self.headers(
+            ['post:drinks']), json={'title': 'latte'})
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_drinks_pages(self):
+        with app.app_context():
+            Drink.insert_many([('drink {}'.format(i), [
+                {'name': 'milk', 'color': 'white', 'parts': i}])
+                for i in range(4)])
+        res = self.client().get('/drinks?limit=3')
+        data = json.loads(res.data)
+        self.assertEqual([d['id'] for d in data['drinks']], [1, 2, 3])
+        self.assertEqual(data['next'], 3)
+        res = self.client().get('/drinks?limit=3&after=3')
+        data = json.loads(res.data)
+        self.assertEqual([d['id'] for d in data['drinks']], [4, 5])
+        self.assertEqual(data['drinks'][1]['recipe'],
+                         [{'color': 'white', 'parts': 3}])
+        self.assertIsNone(data['next'])
+
+    def test_get_drinks_detail_fields(self):
+        headers = self.headers(['get:drinks-detail'])
+        res = self.client().get('/drinks-detail?fields=title',
+                                headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(data['drinks'], [{'id': 1, 'title': 'water'}])
+        res = self.client().get('/drinks-detail?fields=recipe',
+                                headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(data['drinks'], [{'id': 1, 'recipe': [
+            {'color': 'blue', 'name': 'water', 'parts': 1}]}])
+
+    def test_get_drinks_invalid_page(self):
+        for query in ('limit=0', 'limit=x', 'after=x', 'fields=price'):
+            res = self.client().get('/drinks?' + query)
+            self.assertEqual(res.status_code, 400)
+
+    def test_sqlite_profile_is_applied(self):
+        with app.app_context():
+            journal_mode = db.session.execute('PRAGMA journal_mode').scalar()
+            busy_timeout = db.session.execute('PRAGMA busy_timeout').scalar()
+        self.assertEqual(journal_mode, 'wal')
+        self.assertEqual(busy_timeout, 5000)
+
+    def test_drink_rows_match_drinks(self):
+        with app.app_context():
+            Drink.insert_many([('latte', [
+                {'name': 'milk', 'color': 'white', 'parts': 3},
+                {'name': 'espresso', 'color': 'brown', 'parts': 1}]),
+                ('empty', [])])
+            drinks = Drink.query.order_by(Drink.id).all()
+            rows = DrinkRow.load()
+            self.assertEqual([row.short() for row in rows],
+                             [drink.short() for drink in drinks])
+            self.assertEqual([row.long() for row in rows],
+                             [drink.long() for drink in drinks])
+
+    def test_get_drinks_streamed(self):
+        with app.app_context():
+            Drink.insert_many([('drink {}'.format(i), [
+                {'name': 'milk', 'color': 'white', 'parts': i},
+                {'name': 'espresso', 'color': 'brown', 'parts': 1}])
+                for i in range(250)] + [('empty', [])])
+        expected = json.loads(self.client().get('/drinks').data)
+        app.config['STREAM_DRINKS'] = True
+        self.addCleanup(app.config.__setitem__, 'STREAM_DRINKS', False)
+        res = self.client().get('/drinks')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.is_streamed)
+        self.assertEqual(json.loads(res.data), expected)
+
+    def test_get_drinks_streamed_empty_menu(self):
+        with app.app_context():
+            Drink.query.get(1).delete()
+        app.config['STREAM_DRINKS'] = True
+        self.addCleanup(app.config.__setitem__, 'STREAM_DRINKS', False)
+        res = self.client().get('/drinks')
+        self.assertEqual(res.status_code, 404)
+
+    def enable_server_timing(self):
+        app.config['SERVER_TIMING'] = True
+        self.addCleanup(app.config.__setitem__, 'SERVER_TIMING', False)
+        self.addCleanup(route_metrics.clear)
+
+    def test_server_timing(self):
+        self.enable_server_timing()
+        res = self.client().get('/drinks-detail', headers=self.headers(
+            ['get:drinks-detail']))
+        timings = dict(entry.split(';dur=') for entry in
+                       res.headers['Server-Timing'].split(', '))
+        for name in ('auth', 'jwks', 'jwt', 'db', 'serialize', 'total'):
+            self.assertIn(name, timings)
+
+    def test_server_timing_disabled(self):
+        res = self.client().get('/drinks')
+        self.assertNotIn('Server-Timing', res.headers)
+        self.assertEqual(self.client().get('/metrics').status_code, 404)
+
+    def test_metrics(self):
+        self.enable_server_timing()
+        for _ in range(3):
+            self.client().get('/drinks')
+        res = self.client().get('/metrics')
+        body = res.data.decode()
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('coffee_shop_request_duration_seconds_count'
+                      '{method="GET",route="/drinks"} 3', body)
+        self.assertIn('quantile="0.99"', body)
+        self.assertIn('coffee_shop_token_cache_hits_total', body)
+
+    def test_latency_histogram_quantiles(self):
+        histogram = LatencyHistogram(buckets=(1.0, 2.0))
+        for seconds in (0.5, 1.5, 1.5, 1.5):
+            histogram.observe(seconds)
+        self.assertEqual(histogram.quantile(0.25), 1.0)
+        self.assertEqual(histogram.quantile(1.0), 2.0)
+
+    def test_compile_permission(self):
+        granted = frozenset(['get:drinks-detail', 'post:drinks'])
+        self.assertTrue(compile_permission('post:drinks')(granted))
+        self.assertTrue(compile_permission(
+            any_of('patch:drinks', 'post:drinks'))(granted))
+        self.assertFalse(compile_permission(
+            all_of('patch:drinks', 'post:drinks'))(granted))
+        self.assertTrue(compile_permission(all_of(
+            'get:drinks-detail', any_of('delete:drinks', 'post:drinks')))(
+                granted))
+        with self.assertRaises(TypeError):
+            compile_permission(['post:drinks'])
+
+    def test_permissions_are_built_once_per_request(self):
+        payload = {'permissions': ['post:drinks']}
+        with app.test_request_context():
+            self.assertTrue(auth.check_permissions('post:drinks', payload))
+            permissions = auth.granted_permissions(payload)
+            self.assertTrue(auth.check_permissions(
+                any_of('patch:drinks', 'post:drinks'), payload))
+            self.assertIs(auth.granted_permissions(payload), permissions)
+
+    def test_identity_does_not_outlive_the_request(self):
+        headers = self.headers(['get:drinks-detail', 'delete:drinks'])
+        with app.app_context():
+            res = self.client().get('/drinks-detail', headers=headers)
+            self.assertEqual(res.status_code, 200)
+            res = self.client().get('/drinks-detail')
+            self.assertEqual(res.status_code, 401)
+            res = self.client().delete('/drinks/1')
+            self.assertEqual(res.status_code, 401)
+
+    def test_check_permissions_denied(self):
+        with app.test_request_context():
+            with self.assertRaises(Exception) as context:
+                auth.check_permissions(
+                    all_of('patch:drinks', 'post:drinks'),
+                    {'permissions': ['post:drinks']})
+        self.assertEqual(context.exception.code, 403)
+
+    def test_get_drink_changes(self):
+        res = self.client().get('/drinks/changes?since=0')
+        data = json.loads(res.data)
+        self.assertEqual([d['title'] for d in data['drinks']], ['water'])
+        version = data['version']
+
+        headers = self.headers(['post:drinks', 'patch:drinks',
+                                'delete:drinks'])
+        recipe = [{'name': 'tea', 'color': 'brown', 'parts': 1}]
+        self.client().post('/drinks/bulk', headers=headers, json=[
+            {'title': 'tea', 'recipe': recipe},
+            {'title': 'chai', 'recipe': recipe}])
+        self.client().patch('/drinks/2', headers=headers,
+                            json={'title': 'green tea', 'recipe': recipe})
+        self.client().delete('/drinks/1', headers=headers)
+
+        res = self.client().get('/drinks/changes?since={}'.format(version))
+        data = json.loads(res.data)
+        self.assertEqual([d['title'] for d in data['drinks']],
+                         ['chai', 'green tea'])
+        self.assertEqual(data['deleted'], [1])
+        self.assertFalse(data['more'])
+
+        res = self.client().get('/drinks/changes?since={}'.format(
+            data['version']))
+        data = json.loads(res.data)
+        self.assertEqual((data['drinks'], data['deleted']), ([], []))
+
+    def test_get_drink_changes_limit(self):
+        with app.app_context():
+            Drink.insert_many([('drink {}'.format(i), [
+                {'name': 'milk', 'color': 'white', 'parts': 1}])
+                for i in range(4)])
+        seen = []
+        version = 0
+        more = True
+        while more:
+            data = json.loads(self.client().get(
+                '/drinks/changes?limit=2&since={}'.format(version)).data)
+            seen.extend(d['id'] for d in data['drinks'])
+            version, more = data['version'], data['more']
+        self.assertEqual(seen, [1, 2, 3, 4, 5])
+
+    def open_stream(self, headers=None):
+        res = self.client().get('/drinks/stream', headers=headers)
+        self.addCleanup(res.close)
+        events = iter(res.response)
+        self.assertEqual(next(events), b'retry: 3000\n\n')
+        return res, events
+
+    def test_stream_drink_events(self):
+        res, events = self.open_stream()
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        headers = self.headers(['post:drinks', 'delete:drinks'])
+        recipe = [{'name': 'tea', 'color': 'brown', 'parts': 1}]
+        self.client().post('/drinks', headers=headers,
+                           json={'title': 'tea', 'recipe': recipe})
+        self.client().delete('/drinks/1', headers=headers)
+        chunk = b''
+        while chunk.count(b'\n\n') < 2:
+            chunk += next(events)
+        created, deleted = chunk.decode().strip().split('\n\n')
+        self.assertIn('event: created', created)
+        self.assertIn('"title": "tea"', created)
+        self.assertIn('event: deleted\ndata: {"id": 1}', deleted)
+
+    def test_stream_drink_events_resume(self):
+        headers = self.headers(['post:drinks'])
+        recipe = [{'name': 'tea', 'color': 'brown', 'parts': 1}]
+        self.client().post('/drinks', headers=headers,
+                           json={'title': 'tea', 'recipe': recipe})
+        last_event_id = menu_events.latest_id()
+        self.client().post('/drinks', headers=headers,
+                           json={'title': 'chai', 'recipe': recipe})
+        res, events = self.open_stream(
+            {'Last-Event-ID': str(last_event_id)})
+        chunk = next(events).decode()
+        self.assertIn('id: {}\n'.format(last_event_id + 1), chunk)
+        self.assertIn('"title": "chai"', chunk)
+
+    def test_stream_drink_events_reset(self):
+        res, events = self.open_stream({'Last-Event-ID': '-5'})
+        chunk = next(events).decode()
+        self.assertIn('event: reset\ndata: {"since": -5}', chunk)
+
+    def test_stream_drink_events_heartbeat(self):
+        heartbeat = menu_events.heartbeat
+        menu_events.heartbeat = 0.01
+        self.addCleanup(setattr, menu_events, 'heartbeat', heartbeat)
+        res, events = self.open_stream()
+        self.assertEqual(next(events), b': heartbeat\n\n')
+
+    def test_events_published_out_of_order_are_sent_in_order(self):
+        events = EventBroadcaster(heartbeat=0.01)
+        stream = events.subscribe(last_event_id=4, current_id=4)
+        next(stream)
+        events.publish([(6, 'updated', {'id': 1})])
+        self.assertEqual(next(stream), b': heartbeat\n\n')
+        events.publish([(5, 'created', {'id': 2})])
+        chunk = next(stream).decode()
+        self.assertLess(chunk.index('id: 5\n'), chunk.index('id: 6\n'))
+        events.publish([(7, 'deleted', {'id': 2})])
+        self.assertIn('id: 7\n', next(stream).decode())
+
+    def test_events_gap_that_is_never_filled_resets(self):
+        events = EventBroadcaster(heartbeat=0.01, gap_timeout=0.05)
+        stream = events.subscribe(last_event_id=4, current_id=4)
+        next(stream)
+        events.publish([(6, 'updated', {'id': 1})])
+        chunk = next(stream)
+        while chunk == b': heartbeat\n\n':
+            chunk = next(stream)
+        self.assertEqual(chunk.decode(),
+                         'id: 4\nevent: reset\ndata: {"since": 4}\n\n')
+        events.publish([(7, 'deleted', {'id': 2})])
+        self.assertIn('id: 7\n', next(stream).decode())
+
+    def test_menu_cache_misses_are_coalesced(self):
+        cache = MenuCache()
+        builds = []
+
+        def build():
+            builds.append(1)
+            # keep the build running until every other thread waits on it
+            deadline = time.monotonic() + 5
+            while cache.flights.coalesced < 7 and \
+                    time.monotonic() < deadline:
+                time.sleep(0.001)
+            return b'menu'
+
+        bodies = []
+        threads = [threading.Thread(
+            target=lambda: bodies.append(cache.get('short', build).body))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(bodies, [b'menu'] * 8)
+        self.assertEqual(cache.flights.stats()['coalesced'], 7)
+
+    def test_menu_cache_build_errors_are_shared(self):
+        cache = MenuCache()
+
+        def build():
+            raise ValueError('database is locked')
+
+        with self.assertRaises(ValueError):
+            cache.get('short', build)
+        self.assertEqual(cache.flights.stats()['in_flight'], 0)
+
+    def enable_tenant_databases(self, max_engines=16, tenants=()):
+        use_tenant_databases(app, os.path.join(self.tmp_dir, 'tenants'),
+                             max_engines=max_engines)
+        self.addCleanup(tenant_engines.configure, None)
+        for tenant in tenants:
+            create_tenant(tenant)
+
+    def test_tenants_have_separate_databases(self):
+        self.enable_tenant_databases(tenants=['harbour', 'market'])
+        res = self.client().post('/drinks', headers=self.headers(
+            ['post:drinks'], tenant='harbour'), json={
+                'title': 'flat white',
+                'recipe': [{'name': 'milk', 'color': 'white', 'parts': 1}]})
+        self.assertEqual(res.status_code, 200)
+
+        harbour = self.client().get('/drinks',
+                                    headers={'X-Tenant-ID': 'harbour'})
+        self.assertEqual([drink['title'] for drink in
+                          json.loads(harbour.data)['drinks']], ['flat white'])
+        # the app database and other tenants are untouched
+        default = json.loads(self.client().get('/drinks').data)
+        self.assertEqual([drink['title'] for drink in default['drinks']],
+                         ['water'])
+        res = self.client().get('/drinks', headers={'X-Tenant-ID': 'market'})
+        self.assertEqual(res.status_code, 404)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.tmp_dir, 'tenants', 'harbour.db')))
+
+    def test_tenant_header_must_match_the_token(self):
+        self.enable_tenant_databases()
+        headers = self.headers(['get:drinks-detail'], tenant='harbour')
+        headers['X-Tenant-ID'] = 'market'
+        res = self.client().get('/drinks-detail', headers=headers)
+        self.assertEqual(res.status_code, 403)
+
+        res = self.client().get('/drinks',
+                                headers={'X-Tenant-ID': '../database'})
+        self.assertEqual(res.status_code, 400)
+
+    def test_tenant_does_not_outlive_the_request(self):
+        self.enable_tenant_databases()
+        with app.app_context():
+            res = self.client().get('/drinks',
+                                    headers={'X-Tenant-ID': 'harbour'})
+            self.assertEqual(res.status_code, 404)
+            res = self.client().get('/drinks')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([drink['title'] for drink in
+                              json.loads(res.data)['drinks']], ['water'])
+
+    def test_tenant_engines_are_evicted(self):
+        self.enable_tenant_databases(max_engines=2, tenants=['a', 'b', 'c'])
+        # counts from a fresh pool, the tenants were opened to create them
+        tenant_engines.configure(tenant_engines.directory, maxsize=2,
+                                 on_open=tenant_engines.on_open)
+        for tenant in ('a', 'b', 'c', 'a'):
+            res = self.client().get('/drinks',
+                                    headers={'X-Tenant-ID': tenant})
+            self.assertEqual(res.status_code, 404)
+        stats = tenant_engines.stats()
+        self.assertEqual(stats['open'], 2)
+        self.assertEqual(stats['opened'], 4)
+        self.assertEqual(stats['evicted'], 2)
+        # the menu caches of evicted tenants go with their engines
+        self.assertEqual(len(menu_caches.all()), 3)
+
+    def test_unknown_tenants_are_not_created(self):
+        self.enable_tenant_databases(tenants=['harbour'])
+        caches = len(menu_caches.all())
+        for i in range(20):
+            res = self.client().get('/drinks',
+                                    headers={'X-Tenant-ID': 'junk{}'.format(i)})
+            self.assertEqual(res.status_code, 404)
+        res = self.client().get('/drinks', headers=self.headers(
+            ['get:drinks-detail'], tenant='junk'))
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual([f for f in os.listdir(os.path.join(
+            self.tmp_dir, 'tenants')) if f.endswith('.db')], ['harbour.db'])
+        self.assertEqual(len(menu_caches.all()), caches)
+
+    def test_create_tenant_command(self):
+        self.enable_tenant_databases()
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['create-tenant', 'harbour'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(tenant_engines.exists('harbour'))
+        result = runner.invoke(args=['create-tenant', '../database'])
+        self.assertNotEqual(result.exit_code, 0)
+
+    def database_file(self):
+        return database_file(app.config['SQLALCHEMY_DATABASE_URI'])
+
+    def test_backup_copies_the_database_in_steps(self):
+        with app.app_context():
+            Drink.insert_many([('drink {}'.format(i), [
+                {'name': 'milk', 'color': 'white', 'parts': 1}])
+                for i in range(500)])
+        progress = []
+        snapshot = os.path.join(self.tmp_dir, 'snapshot.db')
+        report = backup(self.database_file(), snapshot, pages=4, pause=0,
+                        progress=lambda copied, total: progress.append(
+                            (copied, total)))
+
+        self.assertGreater(report.steps, 1)
+        self.assertEqual(progress[-1], (report.pages, report.pages))
+        self.assertLessEqual(report.max_lock_seconds, report.lock_seconds)
+        self.assertFalse(os.path.exists(snapshot + '.partial'))
+        connection = sqlite3.connect(snapshot)
+        self.addCleanup(connection.close)
+        self.assertEqual(connection.execute(
+            'SELECT count(*) FROM drink').fetchone()[0], 501)
+
+    def test_restore_replaces_the_database(self):
+        snapshot = os.path.join(self.tmp_dir, 'snapshot.db')
+        backup(self.database_file(), snapshot)
+        with app.app_context():
+            Drink.query.filter_by(title='water').one().delete()
+            db.session.remove()
+        restore(snapshot, self.database_file())
+        menu_cache.invalidate()
+
+        res = self.client().get('/drinks')
+        self.assertEqual([drink['title'] for drink in
+                          json.loads(res.data)['drinks']], ['water'])
+
+    def test_backup_scheduler_keeps_the_latest_snapshots(self):
+        directory = os.path.join(self.tmp_dir, 'backups')
+        scheduler = BackupScheduler(self.database_file(), directory, keep=2)
+        os.makedirs(directory)
+        for stamp in ('20200101T000000Z', '20200102T000000Z'):
+            open(os.path.join(directory, 'test-{}.db'.format(stamp)),
+                 'w').close()
+        report = scheduler.run_once()
+        self.assertEqual(sorted(os.listdir(directory)), [
+            'test-20200102T000000Z.db', os.path.basename(report.path)])
+
+    def test_backup_finishes_under_concurrent_writes(self):
+        with app.app_context():
+            Drink.insert_many([('drink {}'.format(i), [
+                {'name': 'milk', 'color': 'white', 'parts': 1}])
+                for i in range(500)])
+        stop = threading.Event()
+
+        def write():
+            connection = sqlite3.connect(self.database_file(), timeout=5)
+            i = 0
+            while not stop.is_set():
+                connection.execute(
+                    "INSERT INTO drink (title, version) VALUES (?, 0)",
+                    ('written {}'.format(i),))
+                connection.commit()
+                i += 1
+                time.sleep(0.001)
+            connection.close()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            snapshot = os.path.join(self.tmp_dir, 'snapshot.db')
+            report = backup(self.database_file(), snapshot, pages=1,
+                            pause=0.01, max_restarts=2)
+        finally:
+            stop.set()
+            writer.join()
+
+        self.assertEqual(report.restarts, 3)
+        self.assertTrue(report.single_step)
+        connection = sqlite3.connect(snapshot)
+        self.addCleanup(connection.close)
+        self.assertGreaterEqual(connection.execute(
+            'SELECT count(*) FROM drink').fetchone()[0], 501)
+
+    def test_backup_gives_up_steps_after_max_seconds(self):
+        snapshot = os.path.join(self.tmp_dir, 'snapshot.db')
+        report = backup(self.database_file(), snapshot, pages=1, pause=0,
+                        max_seconds=0)
+        self.assertTrue(report.single_step)
+        self.assertEqual(report.restarts, 0)
+        self.assertEqual(report.steps, 2)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()